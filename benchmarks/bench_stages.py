@@ -0,0 +1,174 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Times every stage of the conversion of a scan, on a synthetic scan or on
+an existing scan directory, and writes the results as JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import astropy
+
+import discos2class
+
+from synthetic import make_scan, add_arguments, scan_options
+
+STAGES = ["load_subscans", "load_summary_info", "convert_cycle",
+          "reduce_cycle", "write_observations"]
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.timings = {}
+
+    def __call__(self, stage):
+        self.stage = stage
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.timings[self.stage] = self.timings.get(self.stage, 0.) + elapsed
+
+
+def time_scan(scan_path, duty_cycle, dest_dir):
+    """
+    Run every conversion stage once
+    @return: dictionary of stage -> seconds, None for stages which could
+    not run
+    """
+    from discos2class.discosscan import DiscosScanConverter
+    timer = StageTimer()
+    converter = DiscosScanConverter(scan_path, duty_cycle)
+    #convert_cycle times the reads, not waits on background threads
+    converter.prefetch_cycles = 0
+    with timer("load_subscans"):
+        converter.load_subscans()
+    with timer("load_summary_info"):
+        converter.load_summary_info()
+    with timer("convert_cycle"):
+        cycles = [converter.convert_cycle(i)
+                  for i in range(converter.cycles_count)]
+    with timer("reduce_cycle"):
+        reduced = [converter.reduce_cycle(scan_cycle, i)
+                   for i, scan_cycle in enumerate(cycles)]
+    converter.close_readers()
+    try:
+        from discos2class.classwriter import ClassWriter
+    except ImportError as e:
+        logger.warning("skipping write_observations: %s" % (e,))
+        timer.timings["write_observations"] = None
+    else:
+        with ClassWriter() as writer:
+            converter.set_output(dest_dir, writer)
+            with timer("write_observations"):
+                for spectra in reduced:
+                    converter.write_observations(spectra)
+                writer.close()
+    return timer.timings
+
+def scan_size(scan_path):
+    return sum(entry.stat().st_size for entry in os.scandir(scan_path)
+               if entry.is_file())
+
+def run(scan_path, duty_cycle, repeat):
+    runs = dict((stage, []) for stage in STAGES)
+    for i in range(repeat):
+        dest_dir = tempfile.mkdtemp(prefix="d2c_bench_out_")
+        try:
+            timings = time_scan(scan_path, duty_cycle, dest_dir)
+        finally:
+            shutil.rmtree(dest_dir, ignore_errors=True)
+        for stage in STAGES:
+            runs[stage].append(timings.get(stage))
+    stages = {}
+    for stage, values in runs.items():
+        if None in values:
+            stages[stage] = None
+            continue
+        stages[stage] = dict(min = min(values),
+                             mean = float(np.mean(values)),
+                             runs = values)
+    return stages
+
+def environment():
+    return dict(discos2class = discos2class.VERSION,
+                python = platform.python_version(),
+                numpy = np.__version__,
+                astropy = astropy.__version__,
+                machine = platform.machine(),
+                system = platform.system())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Time discos2class conversion stages")
+    parser.add_argument('--scan-dir', dest="scan_dir", default=None,
+                        help="time an existing scan instead of a synthetic one")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', default="bench_stages.json",
+                        help="JSON results file, - for standard output")
+    add_arguments(parser)
+    ns = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s",
+                        level=logging.INFO)
+    options = scan_options(ns)
+    tmp_dir = None
+    if ns.scan_dir:
+        scan_path = ns.scan_dir
+        duty_cycle = options["duty_cycle"]
+        options = dict(scan_dir = scan_path, duty_cycle = duty_cycle)
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix="d2c_bench_scan_")
+        scan_path = tmp_dir
+        duty_cycle = options["duty_cycle"]
+        make_scan(scan_path, **options)
+    scan_path = os.path.join(scan_path, "")
+    try:
+        results = dict(benchmark = "stages",
+                       environment = environment(),
+                       scan = options,
+                       input_bytes = scan_size(scan_path),
+                       repeat = ns.repeat,
+                       stages = run(scan_path, duty_cycle, ns.repeat))
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    if ns.output == "-":
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+    else:
+        with open(ns.output, "w") as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+        logger.info("results written to %s" % (ns.output,))
+    for stage in STAGES:
+        if results["stages"][stage] is None:
+            logger.info("%-20s skipped" % (stage,))
+        else:
+            logger.info("%-20s %.4f s" % (stage, results["stages"][stage]["min"]))
@@ -0,0 +1,122 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Times the startup of the discos2class command line tool in fresh python
+processes and checks that heavy modules are not imported when they are
+not needed. Exits with an error when a check fails, so that it can be
+run to catch startup regressions.
+"""
+
+import sys
+import json
+import platform
+import subprocess
+import logging
+logger = logging.getLogger(__name__)
+
+#modules that must not be loaded by invocations which do not convert data
+HEAVY_MODULES = ["astropy", "astropy.io.fits", "astropy.time", "pyclassfiller",
+                 "numpy"]
+
+#each case runs in a new interpreter and prints its wall time, exit status
+#and the heavy modules it loaded
+_CASE = """
+import sys, time, json
+start = time.perf_counter()
+sys.argv = %(argv)r
+status = 0
+try:
+    %(code)s
+except SystemExit as e:
+    status = e.code or 0
+elapsed = time.perf_counter() - start
+sys.stdout = sys.__stdout__
+print(json.dumps(dict(elapsed = elapsed, status = status,
+                      loaded = [m for m in %(heavy)r if m in sys.modules])))
+"""
+
+CASES = [
+    #name, command line, code, heavy modules allowed
+    ("version", ["discos2class", "--version"],
+     "import discos2class; discos2class.cmd_line()", []),
+    ("help", ["discos2class", "--help"],
+     "import discos2class; discos2class.cmd_line()", []),
+    ("import", ["python"],
+     "import discos2class", []),
+    ("import_converter", ["python"],
+     "import discos2class.discosscan", ["numpy"]),
+]
+
+
+def time_case(argv, code):
+    script = _CASE % dict(argv = argv, code = code, heavy = HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", script])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def run(repeat):
+    results = {}
+    for name, argv, code, allowed in CASES:
+        runs = [time_case(argv, code) for i in range(repeat)]
+        loaded = runs[0]["loaded"]
+        results[name] = dict(min = min(r["elapsed"] for r in runs),
+                             runs = [r["elapsed"] for r in runs],
+                             status = runs[0]["status"],
+                             loaded = loaded,
+                             unexpected = [m for m in loaded
+                                           if m not in allowed])
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Time discos2class startup")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        dest="max_seconds",
+                        help="fail when a case takes longer than this")
+    parser.add_argument('-o', '--output', default="bench_startup.json",
+                        help="JSON results file, - for standard output")
+    ns = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s",
+                        level=logging.INFO)
+    results = dict(benchmark = "startup",
+                   python = platform.python_version(),
+                   repeat = ns.repeat,
+                   cases = run(ns.repeat))
+    if ns.output == "-":
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+    else:
+        with open(ns.output, "w") as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+        logger.info("results written to %s" % (ns.output,))
+    failed = False
+    for name, case in sorted(results["cases"].items()):
+        logger.info("%-20s %.4f s" % (name, case["min"]))
+        if case["status"] != 0:
+            logger.error("%s: exit status %s" % (name, case["status"]))
+            failed = True
+        if case["unexpected"]:
+            logger.error("%s: unexpected imports of %s" %
+                         (name, ", ".join(case["unexpected"])))
+            failed = True
+        if ns.max_seconds is not None and case["min"] > ns.max_seconds:
+            logger.error("%s: %.4f s exceeds %.4f s" % (name, case["min"],
+                                                       ns.max_seconds))
+            failed = True
+    sys.exit(1 if failed else 0)
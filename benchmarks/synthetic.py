@@ -0,0 +1,169 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Generator of synthetic DISCOS/XARCOS scan directories, made of a summary
+file and of subscans with SECTION TABLE, RF INPUTS and DATA TABLE
+extensions laid out as written by DISCOS.
+"""
+
+import os
+import warnings
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.verify import VerifyWarning
+
+#SIGNAL header value written by DISCOS for each duty cycle flag
+SIGNALS = dict(on = "SIGNAL", off = "REFERENCE", cal = "REFCAL")
+#mean counts of each flag
+LEVELS = dict(on = 110., off = 100., cal = 120.)
+#data channels per bin: stokes sections store LCP, RCP, Q and U
+STOKES_PRODUCTS = 4
+SECONDS_PER_DAY = 86400.
+
+
+def _summary_hdu(sections, rest_frequency, vrad, vframe):
+    header = fits.Header()
+    for i in range(sections):
+        header["RESTFREQ%d" % (i + 1,)] = rest_frequency + i
+    header["VRAD"] = vrad
+    header["VDEF"] = "RADI"
+    header["VFRAME"] = vframe
+    return fits.PrimaryHDU(header=header)
+
+def _subscan_hdus(flag, subscan_id, scan_id, source, sections, bins, stokes,
+                  dumps, integration, mjd, rng):
+    header = fits.Header()
+    header["SIGNAL"] = SIGNALS[flag]
+    header["SiteLongitude"] = 0.1984
+    header["SiteLatitude"] = 0.7725
+    header["RightAscension"] = 0.6
+    header["Declination"] = 1.08
+    header["DATE"] = "2016-03-31T11:00:00"
+    header["ANTENNA"] = "MEDICINA"
+    header["SCANID"] = scan_id
+    header["SubScanID"] = subscan_id
+    header["SOURCE"] = source
+    section_type = "stokes" if stokes else "simple"
+    section_table = fits.BinTableHDU.from_columns([
+        fits.Column("id", "J", array=np.arange(sections)),
+        fits.Column("type", "8A", array=[section_type] * sections),
+        fits.Column("bins", "J", array=[bins] * sections),
+        fits.Column("bandwidth", "D", array=[2.0] * sections),
+    ], name="SECTION TABLE")
+    section_table.header["Integration"] = integration
+    if stokes:
+        rf_rows = [(s, pol) for s in range(sections) for pol in ("LCP", "RCP")]
+    else:
+        rf_rows = [(s, "LCP") for s in range(sections)]
+    rf_inputs = fits.BinTableHDU.from_columns([
+        fits.Column("feed", "J", array=[0] * len(rf_rows)),
+        fits.Column("polarization", "3A", array=[pol for _, pol in rf_rows]),
+        fits.Column("section", "J", array=[s for s, _ in rf_rows]),
+        fits.Column("frequency", "D", array=[6667.0] * len(rf_rows)),
+        fits.Column("localOscillator", "D", array=[6000.0] * len(rf_rows)),
+        fits.Column("calibrationMark", "D", array=[10.0] * len(rf_rows)),
+    ], name="RF INPUTS")
+    width = bins * (STOKES_PRODUCTS if stokes else 1)
+    columns = [
+        fits.Column("time", "D",
+                    array=mjd + np.arange(dumps) * integration / 1000. /
+                          SECONDS_PER_DAY),
+        fits.Column("az", "D", array=np.ones(dumps)),
+        fits.Column("el", "D", array=np.full(dumps, 0.8)),
+        fits.Column("weather", "3D", array=np.tile([50., 10., 1000.],
+                                                   (dumps, 1))),
+    ]
+    for s in range(sections):
+        data = LEVELS[flag] + rng.standard_normal((dumps, width))
+        columns.append(fits.Column("Ch%d" % (s,), "%dE" % (width,),
+                                   array=data.astype(np.float32)))
+    data_table = fits.BinTableHDU.from_columns(columns, name="DATA TABLE")
+    return fits.HDUList([fits.PrimaryHDU(header=header), section_table,
+                         rf_inputs, data_table])
+
+def make_scan(path, sections=4, bins=1024, stokes=True, dumps=10,
+              duty_cycle=None, cycles=2, integration=1000, mjd=57478.45,
+              source="w3oh", scan_id=1, seed=0, rest_frequency=6668.5,
+              vrad=-45.0, vframe="LSRK"):
+    """
+    Write a synthetic scan directory
+    @param duty_cycle: dictionary of on, off and cal subscans per cycle
+    @param integration: milliseconds of each dump
+    @return: the list of written subscan paths
+    """
+    if duty_cycle is None:
+        duty_cycle = dict(on = 4, off = 4, cal = 2)
+    rng = np.random.default_rng(seed)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with warnings.catch_warnings():
+        #DISCOS keywords are longer than 8 characters
+        warnings.simplefilter("ignore", VerifyWarning)
+        _summary_hdu(sections, rest_frequency, vrad, vframe).writeto(
+            os.path.join(path, "summary.fits"), overwrite=True)
+        subscan_paths = []
+        flags = []
+        for i in range(cycles):
+            for flag in ("on", "off", "cal"):
+                flags.extend([flag] * duty_cycle.get(flag, 0))
+        for subscan_id, flag in enumerate(flags, 1):
+            subscan_path = os.path.join(path, "%s_%03d_%03d.fits" %
+                                        (source, scan_id, subscan_id))
+            _subscan_hdus(flag, subscan_id, scan_id, source, sections, bins,
+                          stokes, dumps, integration, mjd, rng).writeto(
+                              subscan_path, overwrite=True)
+            subscan_paths.append(subscan_path)
+            #one dump of slewing between subscans
+            mjd += (dumps + 1) * integration / 1000. / SECONDS_PER_DAY
+    logger.debug("written %d subscans in %s" % (len(subscan_paths), path))
+    return subscan_paths
+
+def add_arguments(parser):
+    parser.add_argument('--sections', type=int, default=4)
+    parser.add_argument('--bins', type=int, default=1024)
+    parser.add_argument('--simple', action='store_true', default=False,
+                        help="simple sections instead of stokes")
+    parser.add_argument('--dumps', type=int, default=10,
+                        help="dumps per subscan")
+    parser.add_argument('-c', '--duty-cycle', default="4:4:2", dest="duty_cycle",
+                        help="\"<on>:<off>:<cal>\" subscans per cycle")
+    parser.add_argument('--cycles', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+
+def scan_options(ns):
+    from discos2class import parse_onoff_duty_cycle
+    return dict(sections = ns.sections,
+                bins = ns.bins,
+                stokes = not ns.simple,
+                dumps = ns.dumps,
+                duty_cycle = parse_onoff_duty_cycle(ns.duty_cycle),
+                cycles = ns.cycles,
+                seed = ns.seed)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic DISCOS scan")
+    parser.add_argument('scan_dir', help="output scan directory")
+    add_arguments(parser)
+    ns = parser.parse_args()
+    make_scan(ns.scan_dir, **scan_options(ns))
@@ -38,10 +38,56 @@ def parse_onoff_duty_cycle(duty_cycle):
     return output_duty_cycle
 
 
+def reduced_spectra(scan_path, duty_cycle="4:4:2", skip_calibration=False,
+                    memory_budget=64 * 1024 * 1024, average_cycles=1,
+                    resampler=None, flagging=None, switching=None,
+                    prefetch_cycles=2):
+    """
+    Reduce a DISCOS scan in memory without writing CLASS files. Subscans
+    are indexed and the summary is read immediately, while spectral data
+    is read as spectra are requested: besides the current cycle, only the
+    next prefetch_cycles cycles are read ahead in memory.
+    @param duty_cycle: "<on>:<off>:<cal>" string or dictionary, "auto" or
+    None to infer it from subscan SIGNAL headers
+    @param memory_budget: maximum bytes of a data column read at once
+    @param average_cycles: number of consecutive cycles averaged into each
+    spectrum, 0 to average the whole scan
+    @param resampler: optional discos2class.resample.Resampler selecting
+    and rebinning the channels of each section
+    @param flagging: optional discos2class.flagging.RFIFlagging of rows
+    and channels
+    @param switching: "nearest" or "interpolate" to pair runs of on
+    subscans with shared off and cal references instead of using the duty
+    cycle
+    @param prefetch_cycles: number of cycles read ahead by background
+    threads, 0 reads each cycle only when its spectra are requested
+    @return: a generator of ReducedSpectrum, one per (averaged) cycle,
+    section and polarization, each holding the calibrated spectrum as a numpy array in
+    its data attribute together with its header values
+    """
+    from .discosscan import DiscosScanConverter
+    if duty_cycle == "auto":
+        duty_cycle = None
+    elif duty_cycle is not None and not isinstance(duty_cycle, dict):
+        duty_cycle = parse_onoff_duty_cycle(duty_cycle)
+    converter = DiscosScanConverter(scan_path, duty_cycle, skip_calibration,
+                                    memory_budget, average_cycles)
+    converter.resampler = resampler
+    converter.flagging = flagging
+    converter.switching_mode = switching
+    converter.prefetch_cycles = prefetch_cycles
+    converter.load_subscans()
+    converter.check_duty_cycle()
+    converter.load_summary_info()
+    return converter.reduce_scan()
+
+
 def cmd_line():
     import argparse
     import os
     import sys
+    import time
+    import signal
 
     #Adding command line options
     parser = argparse.ArgumentParser(description="Convert discos SCANs into class files")
@@ -54,20 +100,151 @@ def cmd_line():
                         dest="duty_cycle",
                         help="scan duty cycle as \"<on>:<off>:<cal>\", elements\
                         must be all presente but can be zeroes.")
+    parser.add_argument('--auto-duty-cycle', action='store_true',
+                        default=False, dest="auto_duty_cycle",
+                        help="infer the duty cycle of each scan from the \
+                              SIGNAL header of its subscans, ignoring -c")
+    parser.add_argument('--switching', default=None, dest="switching",
+                        choices=["nearest", "interpolate"],
+                        help="ignore -c and pair each run of on subscans with \
+                              the off and cal runs nearest in time, or \
+                              interpolate the ones before and after, so that \
+                              references can be shared by several on runs")
+    parser.add_argument('--reference-cache', type=int, default=4,
+                        dest="reference_cache", metavar="N",
+                        help="with --switching, reduced off and cal runs kept \
+                              in memory")
+    parser.add_argument('--plan', action='store_true', default=False,
+                        dest="plan",
+                        help="only read subscan headers and report how each \
+                              scan groups into cycles, without converting")
     parser.add_argument('-s', '--skip-calibration', action='store_true',
                         default=False, dest="skip_calibration",
                         help="skip kelvin calibration and computes only \
                               ((on - off) / off) ignoring CAL signal")
+    parser.add_argument('-A', '--average', type=int, default=1,
+                        dest="average_cycles", metavar="N",
+                        help="write the integration weighted average of N \
+                              consecutive cycles, 0 averages whole scans")
+    parser.add_argument('--rebin', action='append', default=None,
+                        dest="rebin", metavar="[SECTION=]N",
+                        help="average groups of N adjacent channels, of every \
+                              section or of the given section id, can be \
+                              repeated")
+    parser.add_argument('--channel-range', action='append', default=None,
+                        dest="channel_range", metavar="[SECTION=]START:STOP",
+                        help="keep only channels from START to STOP excluded, \
+                              counted from 0, of every section or of the given \
+                              section id, can be repeated")
+    parser.add_argument('--flag-sigma', type=float, default=None,
+                        dest="flag_sigma", metavar="SIGMA",
+                        help="drop dumps whose total power is more than SIGMA \
+                              robust standard deviations away from the median \
+                              of the subscan")
+    parser.add_argument('--channel-mask', default=None, dest="channel_mask",
+                        metavar="FILE",
+                        help="file of [SECTION=]START:STOP channel ranges, one \
+                              per line, blanked in written spectra")
+    parser.add_argument('-j', '--jobs', type=int, default=1, dest="jobs",
+                        help="number of scans converted in parallel worker \
+                              processes")
+    parser.add_argument('-m', '--memory-budget', type=int, default=64,
+                        dest="memory_budget",
+                        help="maximum MB of spectral data read at once from \
+                              each subscan data column, and of gzip subscans \
+                              decompressed ahead of reading")
+    parser.add_argument('--decompress-threads', type=int, default=4,
+                        dest="decompress_threads", metavar="N",
+                        help="threads decompressing gzip subscans of each \
+                              scan ahead of their reduction")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        dest="prefetch_cycles", metavar="N",
+                        help="cycles read ahead by background threads while \
+                              the current one is reduced and written, 0 reads \
+                              synchronously")
+    parser.add_argument('-w', '--watch', action='store_true', default=False,
+                        dest="watch",
+                        help="follow scans while they are acquired, source \
+                              directories can be scans or directories \
+                              containing scans")
+    parser.add_argument('--watch-timeout', type=float, default=120.,
+                        dest="watch_timeout",
+                        help="seconds without new subscans after which a \
+                              watched scan is complete")
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        dest="force",
+                        help="convert again scans and cycles already recorded \
+                              in the output directory manifest, needed when \
+                              reduction options changed")
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        default=False, dest="recursive",
+                        help="source directories are archive roots, convert \
+                              every scan found below them")
+    parser.add_argument('--since', default=None, dest="since",
+                        metavar="YYYY-MM-DD",
+                        help="with -r, only scans recorded from this date")
+    parser.add_argument('--until', default=None, dest="until",
+                        metavar="YYYY-MM-DD",
+                        help="with -r, only scans recorded up to this date")
+    parser.add_argument('--source', action='append', default=None,
+                        dest="sources", metavar="SOURCE",
+                        help="with -r, only scans of this source, can be \
+                              repeated")
+    parser.add_argument('--match', default=None, dest="match",
+                        metavar="GLOB",
+                        help="with -r, only scans whose path relative to the \
+                              archive root matches this pattern")
+    parser.add_argument('-a', '--archive', default=None, dest="archive",
+                        choices=["npz", "fits"],
+                        help="also write the reduced spectra of each scan to \
+                              a columnar archive in the output directory")
+    parser.add_argument('--stats-json', default=None, dest="stats_json",
+                        metavar="FILE",
+                        help="write time spent in each conversion stage, \
+                              files opened and bytes read as a JSON report")
+    parser.add_argument('--profile', default=None, dest="profile",
+                        metavar="FILE",
+                        help="run the conversion under cProfile and dump \
+                              the profile statistics to FILE")
     parser.add_argument('source_dir', nargs='+',
                         help='directory path(s) to scans')
-    parser.add_argument('--version', action='store_true', dest='show_version',
+    parser.add_argument('--version', action='version',
+                        version="discos2class v%s" % (VERSION,),
                         help='print version information and exit')
 
     #parsing command line arguments
     ns = parser.parse_args()
-    if ns.show_version:
-        print(("discos2class v%s" % (VERSION,)))
-        sys.exit()
+    if ns.average_cycles < 0:
+        parser.error("--average must be a positive number of cycles or 0")
+    from .resample import Resampler, parse_rebin, parse_channel_range
+    try:
+        resampler = Resampler(parse_channel_range(ns.channel_range),
+                              parse_rebin(ns.rebin))
+    except ValueError as e:
+        parser.error(str(e))
+    from .flagging import RFIFlagging, load_channel_mask
+    if ns.flag_sigma is not None and ns.flag_sigma <= 0:
+        parser.error("--flag-sigma must be positive")
+    try:
+        flagging = RFIFlagging(ns.flag_sigma,
+                               ns.channel_mask and load_channel_mask(ns.channel_mask))
+    except (IOError, ValueError) as e:
+        parser.error("cannot load channel mask: %s" % (e,))
+    if ns.decompress_threads < 1:
+        parser.error("--decompress-threads must be at least 1")
+    if ns.prefetch_cycles < 0:
+        parser.error("--prefetch must be a positive number of cycles or 0")
+    if ns.recursive and ns.watch:
+        parser.error("--recursive cannot be used with --watch, watched \
+directories are already searched for new scans")
+    if ns.watch and (ns.auto_duty_cycle or ns.plan or ns.switching):
+        parser.error("--auto-duty-cycle, --switching and --plan cannot be used \
+with --watch")
+    if ns.switching and ns.auto_duty_cycle:
+        parser.error("--switching does not use a duty cycle, it cannot be used \
+with --auto-duty-cycle")
+    if ns.reference_cache < 1:
+        parser.error("--reference-cache must be at least 1")
     #setting logger level and format
     if ns.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -75,30 +252,76 @@ def cmd_line():
         logging.basicConfig(format="%(levelname)s: %(message)s",
                             level=logging.INFO)
     logger = logging.getLogger("discos2class")
-    duty_cycle = parse_onoff_duty_cycle(ns.duty_cycle)
+    if ns.auto_duty_cycle:
+        duty_cycle = None
+    else:
+        duty_cycle = parse_onoff_duty_cycle(ns.duty_cycle)
     logger.debug("Running with options:")
     for k,v in vars(ns).items():
         logger.debug("\t%s:\t%s" % (k, str(v),))
 
-    from .discosscan import DiscosScanConverter
+    from .batch import convert_scans, log_summary, plan_scans
+    from .manifest import ConversionManifest
 
-    if not os.path.isdir(ns.output_dir):
+    if not ns.plan and not os.path.isdir(ns.output_dir):
         logging.debug("creating directory: %s" % (ns.output_dir,))
         try:
             os.makedirs(ns.output_dir)
         except Exception as e:
             logging.warning("cannot create directory: %s" % (ns.output_dir,))
-    for input_scan_directory in ns.source_dir:
+    manifest = ConversionManifest(ns.output_dir)
+    #on SIGTERM close CLASS files and fold the manifest journal as on ^C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    if ns.watch:
+        from .watch import watch
+        watch(ns.source_dir, duty_cycle, ns.output_dir, ns.skip_calibration,
+              ns.memory_budget * 1024 * 1024, idle_timeout=ns.watch_timeout,
+              manifest=manifest, archive_format=ns.archive,
+              average_cycles=ns.average_cycles, resampler=resampler,
+              flagging=flagging, prefetch_cycles=ns.prefetch_cycles,
+              force=ns.force)
+        return
+    scan_paths = ns.source_dir
+    if ns.recursive:
+        from .discovery import find_scans, ScanFilter, parse_date
         try:
-            converter = DiscosScanConverter(input_scan_directory, duty_cycle,
-                                            ns.skip_calibration)
-            converter.load_subscans()
-            converter.load_summary_info()
-            converter.convert_subscans(ns.output_dir)
-        except Exception as e:
-            if ns.debug:
-                raise
-            else:
-                logging.error("cannot convert scan at: %s" % (input_scan_directory,))
-                logging.error(e.message)
-
+            scan_filter = ScanFilter(ns.since and parse_date(ns.since),
+                                     ns.until and parse_date(ns.until),
+                                     ns.sources, ns.match)
+        except ValueError as e:
+            parser.error(str(e))
+        scan_paths = find_scans(ns.source_dir, scan_filter)
+        if not scan_paths:
+            logger.warning("no scans found")
+            return
+    if ns.plan:
+        if plan_scans(scan_paths, duty_cycle, ns.switching):
+            sys.exit(1)
+        return
+    if ns.profile:
+        import cProfile
+        if ns.jobs > 1:
+            logger.warning("profiling only the main process, worker processes "
+                           "are not profiled")
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        results = convert_scans(scan_paths, duty_cycle, ns.output_dir,
+                                ns.skip_calibration, ns.jobs, ns.debug,
+                                ns.memory_budget * 1024 * 1024, manifest,
+                                ns.archive, ns.average_cycles, resampler,
+                                flagging, ns.decompress_threads,
+                                ns.prefetch_cycles, ns.switching,
+                                ns.reference_cache, ns.force)
+    finally:
+        manifest.flush()
+        if ns.profile:
+            profiler.disable()
+            profiler.dump_stats(ns.profile)
+            logger.info("profile written to %s" % (ns.profile,))
+    wall_time = time.perf_counter() - start
+    log_summary(results, ns.debug)
+    if ns.stats_json:
+        from .stats import write_report
+        write_report(ns.stats_json, results, wall_time)
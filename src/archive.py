@@ -0,0 +1,160 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+ARCHIVE_FORMATS = {"npz" : ".npz", "fits" : ".fits"}
+#ReducedSpectrum attributes stored as archive columns, data is stored as a
+#matrix with a row per spectrum padded with NaN up to the longest spectrum
+COLUMNS = ["cycle", "section", "polarization", "line", "source_name",
+           "antenna", "scan", "subscan", "mjd", "dobs", "dred", "ut", "st",
+           "az", "el", "ra", "dec", "integration", "tamb", "pamb",
+           "rest_frequency", "nchan", "rchan", "fres", "foff", "vres", "voff",
+           "vframe", "doppler", "tsys"]
+
+
+def archive_path(dest_dir, scan_path, archive_format):
+    return os.path.join(dest_dir,
+                        os.path.basename(os.path.normpath(scan_path)) +
+                        ARCHIVE_FORMATS[archive_format])
+
+def spectra_columns(spectra):
+    """
+    @param spectra: list of ReducedSpectrum
+    @return: dictionary of column name -> numpy array with a row per spectrum
+    """
+    columns = dict((name, np.array([getattr(spectrum, name)
+                                    for spectrum in spectra]))
+                   for name in COLUMNS)
+    width = max([len(spectrum.data) for spectrum in spectra] or [0])
+    data = np.full((len(spectra), width), np.nan)
+    for i, spectrum in enumerate(spectra):
+        data[i, :len(spectrum.data)] = spectrum.data
+    columns["data"] = data
+    return columns
+
+def _concatenate(first, second):
+    width = max(first["data"].shape[1], second["data"].shape[1])
+    columns = {}
+    for name in first:
+        if name == "data":
+            data = np.full((len(first["data"]) + len(second["data"]), width),
+                           np.nan)
+            data[:len(first["data"]), :first["data"].shape[1]] = first["data"]
+            data[len(first["data"]):, :second["data"].shape[1]] = second["data"]
+            columns[name] = data
+        else:
+            columns[name] = np.concatenate((first[name], second[name]))
+    return columns
+
+def _write_npz(path, columns):
+    with open(path, "wb") as archive_file:
+        np.savez(archive_file, **columns)
+
+def _write_fits(path, columns):
+    from astropy.io import fits
+    table = fits.BinTableHDU.from_columns(
+                [fits.Column(name=name, format=_fits_format(columns[name]),
+                             array=columns[name])
+                 for name in COLUMNS + ["data"]],
+                name="SPECTRA")
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(path, overwrite=True)
+
+def _fits_format(column):
+    if column.dtype.kind == "U":
+        return "%dA" % (max(1, column.dtype.itemsize // 4),)
+    elif column.dtype.kind in "iu":
+        return "K"
+    elif column.ndim == 2:
+        return "%dD" % (column.shape[1],)
+    return "D"
+
+def _fits_column(field):
+    column = np.array(field)
+    if column.dtype.kind == "S":
+        column = column.astype("U")
+    return column
+
+def read_archive(path):
+    """
+    Read a whole archive written by ScanArchive in one go
+    @return: dictionary of column name -> numpy array with a row per spectrum
+    """
+    if path.endswith(ARCHIVE_FORMATS["fits"]):
+        from astropy.io import fits
+        with fits.open(path) as archive_file:
+            table = archive_file["SPECTRA"].data
+            return dict((name, _fits_column(table.field(name)))
+                        for name in table.columns.names)
+    with np.load(path) as archive_file:
+        return dict((name, archive_file[name]) for name in archive_file.files)
+
+
+class ScanArchive(object):
+    """
+    Columnar archive of the reduced spectra of a scan, collected in memory
+    and written with a single sequential write. Rows of cycles converted by
+    previous runs are kept, so that incremental conversions complete the
+    archive.
+    """
+    def __init__(self, path, archive_format="npz"):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError("unknown archive format: %s" % (archive_format,))
+        self.path = path
+        self.archive_format = archive_format
+        self.spectra = []
+
+    def add(self, spectra):
+        self.spectra.extend(spectra)
+
+    def write(self):
+        """
+        Write the collected spectra, if any, merging them with the rows of
+        other cycles already in the archive
+        """
+        if not self.spectra:
+            return
+        columns = spectra_columns(self.spectra)
+        if os.path.exists(self.path):
+            try:
+                previous = read_archive(self.path)
+            except Exception as e:
+                logger.warning("cannot read archive %s, overwriting it: %s" %
+                               (self.path, e))
+            else:
+                keep = ~np.isin(previous["cycle"], columns["cycle"])
+                if keep.any():
+                    columns = _concatenate(dict((name, value[keep])
+                                                for name, value in
+                                                previous.items()),
+                                           columns)
+        order = np.argsort(columns["cycle"], kind="stable")
+        columns = dict((name, value[order]) for name, value in columns.items())
+        tmp_path = self.path + ".tmp"
+        if self.archive_format == "fits":
+            _write_fits(tmp_path, columns)
+        else:
+            _write_npz(tmp_path, columns)
+        os.replace(tmp_path, self.path)
+        logger.info("%d spectra archived in %s" % (len(columns["cycle"]),
+                                                   self.path))
+        self.spectra = []
@@ -0,0 +1,289 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+logger = logging.getLogger(__name__)
+import operator
+import itertools
+import collections
+import multiprocessing
+import traceback
+
+from .discosscan import DiscosScanConverter, DEFAULT_PREFETCH_CYCLES
+from .scancycle import DEFAULT_MEMORY_BUDGET
+from .compressed import DEFAULT_DECOMPRESS_THREADS
+from .switching import DEFAULT_REFERENCE_CACHE
+
+
+class ScanResult(object):
+    def __init__(self, scan_path, observations=0, error=None, details=None,
+                 skipped=False, stats=None):
+        self.scan_path = scan_path
+        self.observations = observations
+        self.error = error
+        self.details = details
+        self.skipped = skipped
+        self.stats = stats
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _load_scan(args):
+    (scan_path, duty_cycle, skip_calibration, memory_budget, average_cycles,
+     resampler, flagging, decompress_threads, prefetch_cycles, switching,
+     reference_cache, manifest, dest_dir, archive_format, reraise) = args
+    try:
+        converter = DiscosScanConverter(scan_path, duty_cycle, skip_calibration,
+                                        memory_budget, average_cycles)
+        converter.resampler = resampler
+        converter.flagging = flagging
+        converter.decompressor.threads = decompress_threads
+        converter.prefetch_cycles = prefetch_cycles
+        converter.switching_mode = switching
+        converter.references.size = reference_cache
+        converter.manifest = manifest
+        if archive_format:
+            converter.set_archive(dest_dir, archive_format)
+        if((manifest is not None) and
+           manifest.scan_done(scan_path, converter.list_subscan_files(),
+                              converter.reduction_options())):
+            logger.debug("%s: unchanged since last conversion" % (scan_path,))
+            return None, ScanResult(scan_path, skipped=True)
+        converter.check_options()
+        with converter.stats.wall_clock():
+            converter.load_subscans()
+            converter.check_duty_cycle()
+            converter.load_summary_info()
+        return converter, None
+    except Exception as e:
+        if reraise:
+            raise
+        return None, ScanResult(scan_path, error=str(e),
+                                details=traceback.format_exc())
+
+def _reduce_scan(converter):
+    """
+    Worker side of a parallel conversion: spectra are reduced here and sent
+    back to the parent process which is the only one writing CLASS files
+    @return: (spectra, worker stats, failure)
+    """
+    try:
+        with converter.stats.wall_clock():
+            spectra = list(converter.reduce_scan())
+        return spectra, converter.stats, None
+    except Exception as e:
+        return None, converter.stats, ScanResult(converter.scan_path,
+                                                 error=str(e),
+                                                 details=traceback.format_exc(),
+                                                 stats=converter.stats)
+
+def _reduce_scans(pool, converters, window):
+    """
+    Reduce scans in a pool keeping at most window scans in flight, so that
+    spectra waiting to be written do not pile up when writing is slower
+    than reducing
+    @return: generator of (converter, _reduce_scan result) in input order
+    """
+    queued = iter(converters)
+    pending = collections.deque()
+    def submit():
+        converter = next(queued, None)
+        if converter is not None:
+            pending.append((converter,
+                            pool.apply_async(_reduce_scan, (converter,))))
+    for i in range(window):
+        submit()
+    while pending:
+        converter, result = pending.popleft()
+        reduced = result.get()
+        #the next scan is reduced while this one is written
+        submit()
+        yield converter, reduced
+
+def convert_scans(scan_paths, duty_cycle, dest_dir, skip_calibration=False,
+                  jobs=1, debug=False, memory_budget=DEFAULT_MEMORY_BUDGET,
+                  manifest=None, archive_format=None, average_cycles=1,
+                  resampler=None, flagging=None,
+                  decompress_threads=DEFAULT_DECOMPRESS_THREADS,
+                  prefetch_cycles=DEFAULT_PREFETCH_CYCLES, switching=None,
+                  reference_cache=DEFAULT_REFERENCE_CACHE, force=False):
+    """
+    Convert a list of scan directories into CLASS files in dest_dir.
+    With jobs > 1 scans are indexed and reduced by a pool of worker
+    processes while this process writes their spectra in input order, so
+    that scans sharing the same output file are appended deterministically.
+    At most jobs scans are reduced ahead of the one being written.
+    @param manifest: a ConversionManifest used to skip scans and cycles
+    already converted
+    @param archive_format: when given, reduced spectra of every scan are also
+    written to a columnar archive in this format
+    @param average_cycles: number of consecutive cycles averaged into each
+    written spectrum, 0 to average whole scans
+    @param resampler: optional Resampler selecting and rebinning channels
+    @param flagging: optional RFIFlagging of rows and channels
+    @param decompress_threads: threads decompressing gzip subscans of each
+    scan ahead of their reduction
+    @param prefetch_cycles: cycles of each scan read ahead by background
+    threads while the current one is reduced and written, 0 to read
+    synchronously
+    @param switching: optional switching mode, "nearest" or "interpolate",
+    pairing runs of on subscans with shared off and cal references instead
+    of using the duty cycle
+    @param reference_cache: reduced reference runs kept in memory in
+    switching mode
+    @param force: forget the manifest records of the given scans and
+    convert them again
+    @return: a list of ScanResult in input order
+    """
+    if force and manifest is not None:
+        for scan_path in scan_paths:
+            manifest.forget(scan_path)
+    results = []
+    converters = []
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        _map = pool.imap
+    else:
+        _map = map
+    try:
+        for converter, failure in _map(_load_scan,
+                                       [(scan_path, duty_cycle, skip_calibration,
+                                         memory_budget, average_cycles,
+                                         resampler, flagging,
+                                         decompress_threads,
+                                         prefetch_cycles, switching,
+                                         reference_cache, manifest,
+                                         dest_dir, archive_format,
+                                         debug and not pool)
+                                        for scan_path in scan_paths]):
+            if failure:
+                results.append(failure)
+            else:
+                #converters loaded by workers carry a copy of the manifest
+                converter.manifest = manifest
+                converters.append(converter)
+        if not converters:
+            #nothing to write, do not even load pyclassfiller
+            return _sorted_results(results, scan_paths)
+        from .classwriter import ClassWriter
+        with ClassWriter() as writer:
+            for converter in converters:
+                for path, count in converter.count_observations(dest_dir).items():
+                    writer.reserve(path, count)
+            if pool:
+                for converter, (spectra, stats, failure) in _reduce_scans(
+                                                pool, converters, jobs):
+                    if failure:
+                        results.append(failure)
+                        continue
+                    converter.stats = stats
+                    converter.set_output(dest_dir, writer)
+                    try:
+                        #cycles are recorded as soon as they are written, as
+                        #in a sequential conversion
+                        with stats.wall_clock():
+                            for cycle, cycle_spectra in itertools.groupby(
+                                    spectra, operator.attrgetter("cycle")):
+                                cycle_spectra = list(cycle_spectra)
+                                observations = converter.write_observations(cycle_spectra)
+                                if converter.archive is not None:
+                                    converter.archive.add(cycle_spectra)
+                                converter.record_cycle(cycle, observations)
+                            converter.write_archive()
+                            converter.record_scan()
+                    except Exception as e:
+                        if debug:
+                            raise
+                        results.append(ScanResult(converter.scan_path,
+                                                  error=str(e),
+                                                  details=traceback.format_exc(),
+                                                  stats=stats))
+                        continue
+                    results.append(ScanResult(converter.scan_path, len(spectra),
+                                              stats=stats))
+            else:
+                for converter in converters:
+                    written = sum(writer.written.values())
+                    try:
+                        with converter.stats.wall_clock():
+                            converter.convert_subscans(dest_dir, writer)
+                    except Exception as e:
+                        if debug:
+                            raise
+                        results.append(ScanResult(converter.scan_path,
+                                                  error=str(e),
+                                                  details=traceback.format_exc(),
+                                                  stats=converter.stats))
+                        continue
+                    results.append(ScanResult(converter.scan_path,
+                                      sum(writer.written.values()) - written,
+                                      stats=converter.stats))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return _sorted_results(results, scan_paths)
+
+def _sorted_results(results, scan_paths):
+    order = dict((scan_path, i) for i, scan_path in enumerate(scan_paths))
+    results.sort(key=lambda x:order[x.scan_path])
+    return results
+
+def plan_scans(scan_paths, duty_cycle, switching=None):
+    """
+    Dry run: index scans reading only their headers and log how subscans
+    group into cycles, with mismatched and partial cycles
+    @param duty_cycle: duty cycle dictionary, None to infer it
+    @param switching: optional switching mode replacing the duty cycle
+    @return: number of scans which cannot be converted
+    """
+    invalid = 0
+    for scan_path in scan_paths:
+        try:
+            converter = DiscosScanConverter(scan_path, duty_cycle)
+            converter.switching_mode = switching
+            converter.load_subscans()
+            plan = converter.plan()
+        except Exception as e:
+            logger.error("%s: %s" % (scan_path, e))
+            invalid += 1
+            continue
+        plan.log(scan_path)
+        if converter.SUMMARY is None:
+            logger.error("%s: no summary file" % (scan_path,))
+        if converter.SUMMARY is None or not plan.valid:
+            invalid += 1
+    logger.info("%d of %d scans can be converted" %
+                (len(scan_paths) - invalid, len(scan_paths)))
+    return invalid
+
+def log_summary(results, debug=False):
+    logger.info("conversion summary:")
+    for result in results:
+        if result.skipped:
+            logger.info("  SKIPPED %s (unchanged)" % (result.scan_path,))
+        elif result.ok:
+            logger.info("  OK      %s (%d observations)" % (result.scan_path,
+                                                            result.observations))
+        else:
+            logger.error("  FAILED  %s: %s" % (result.scan_path, result.error))
+            if debug:
+                logger.debug(result.details)
@@ -0,0 +1,200 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import atexit
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pyclassfiller
+from pyclassfiller import code
+
+from .metadata import mjd2datetime
+
+FILE_EXTENSION = ".d2c"
+#index size used when the number of observations is not known in advance
+DEFAULT_INDEX_SIZE = 999999
+#CLASS value of blanked channels, written in place of NaN
+BLANKING_VALUE = -1000.
+
+
+def output_file_name(mjd, source_name):
+    """
+    CLASS files collect the observations of a source in the same day
+    """
+    return mjd2datetime(mjd).strftime("%Y%j") + "_" + source_name + \
+           FILE_EXTENSION
+
+def _velocity_type(vframe):
+    if vframe == "BARY":
+        logger.debug("velocity: HELIO")
+        return code.velo.helio
+    elif((vframe == "LSRK") or
+       (vframe == "LSRD")):
+        logger.debug("velocity: LSR")
+        return code.velo.lsr
+    elif vframe == "TOPCEN":
+        logger.debug("velocity: OBS")
+        return code.velo.obs
+    else:
+        logger.debug("velocity: UNK")
+        return code.velo.unk
+
+def class_observation(spectrum):
+    """
+    Build a pyclassfiller observation from a ReducedSpectrum, NaN channels
+    are written as BLANKING_VALUE
+    """
+    obs = pyclassfiller.ClassObservation()
+    obs.head.presec[:]            = False  # Disable all sections except...
+    obs.head.presec[code.sec.gen] = True  # General
+    obs.head.presec[code.sec.pos] = True  # Position
+    obs.head.presec[code.sec.spe] = True  # Spectral observatins  Activate always spectral section to include the name of the line 
+    obs.head.presec[code.sec.cal] = True  # calibration observatins  Activate always spectral section to include the name of the line 
+
+    obs.head.gen.num = 0
+    obs.head.gen.ver = 0
+    obs.head.gen.teles = spectrum.antenna
+    obs.head.gen.dobs = spectrum.dobs
+    obs.head.gen.dred = spectrum.dred
+    obs.head.gen.typec = code.coord.equ
+    obs.head.gen.kind = code.kind.spec
+    obs.head.gen.qual = code.qual.unknown
+    obs.head.gen.scan = spectrum.scan
+    obs.head.gen.subscan = spectrum.subscan
+    obs.head.gen.ut = spectrum.ut
+    obs.head.gen.st = spectrum.st
+    obs.head.gen.az = spectrum.az  # unit radians
+    obs.head.gen.el = spectrum.el # radians
+    obs.head.gen.tau = 0.
+    #FIXME: should we read antenna temperature?
+    obs.head.gen.time = spectrum.integration
+    obs.head.gen.xunit = code.xunit.freq  # Unused
+
+    obs.head.pos.sourc = spectrum.source_name
+    obs.head.pos.epoch = 2000.0
+    obs.head.pos.lam = spectrum.ra
+    obs.head.pos.bet = spectrum.dec
+    obs.head.pos.lamof = 0.
+    obs.head.pos.betof = 0.
+    obs.head.pos.proj = code.proj.none
+    obs.head.pos.sl0p = 0. #FIXME: ?
+    obs.head.pos.sb0p = 0. #FIXME: ?
+    obs.head.pos.sk0p = 0. #FIXME: ?
+
+    obs.head.cal.tamb = spectrum.tamb
+    obs.head.cal.pamb = spectrum.pamb
+    logger.debug("Air temperature  %f Air pressure %f" %  (spectrum.tamb,
+                                                            spectrum.pamb))
+
+    obs.head.spe.restf = spectrum.rest_frequency
+    obs.head.spe.nchan = spectrum.nchan
+    obs.head.spe.rchan = spectrum.rchan
+    logger.debug("central channel  %f" %  spectrum.rchan)
+    obs.head.spe.fres = spectrum.fres
+    obs.head.spe.foff = spectrum.foff
+    logger.debug("offset at 0  %f" %  spectrum.foff)
+    obs.head.spe.vres = spectrum.vres
+    obs.head.spe.voff = spectrum.voff
+    obs.head.spe.bad = BLANKING_VALUE
+    obs.head.spe.image = 0.
+    obs.head.spe.vtype = _velocity_type(spectrum.vframe)
+    obs.head.spe.doppler = spectrum.doppler
+    logger.debug("Doppler  %f" %  obs.head.spe.doppler)
+    obs.head.spe.line = spectrum.line
+    obs.head.gen.tsys = spectrum.tsys
+    data = spectrum.data
+    blanked = np.isnan(data)
+    if blanked.any():
+        data = np.where(blanked, BLANKING_VALUE, data).astype(data.dtype)
+    obs.datay = data
+    return obs
+
+
+class ClassWriter(object):
+    """
+    Keeps CLASS output files open across cycles and scans instead of
+    opening and closing the file for every observation.
+
+    CLASS handles a single output file at a time and pyclassfiller
+    observations are always written to the last opened file, so the pool
+    holds at most one open file: it is closed only when observations are
+    sent to a different destination or when the pool is closed.
+    """
+    def __init__(self):
+        self.path = None
+        self.handle = None
+        self.expected = {}
+        self.written = {}
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def reserve(self, path, count):
+        """
+        Announce count observations that will be written to path, the index
+        of a new file is sized on the total announced count
+        """
+        self.expected[path] = self.expected.get(path, 0) + count
+
+    def open(self, path):
+        if path == self.path:
+            return self.handle
+        self.close()
+        handle = pyclassfiller.ClassFileOut()
+        if os.path.exists(path):
+            handle.open(path,
+                        new = False,
+                        over = False,
+                        size = DEFAULT_INDEX_SIZE,
+                        single = False)
+            logger.info("append observations to file %s" % (path,))
+        else:
+            size = self.expected.get(path, 0) or DEFAULT_INDEX_SIZE
+            handle.open(path,
+                        new = True,
+                        over = False,
+                        size = size,
+                        single = False)
+            logger.info("open new file %s with index size %d" % (path, size))
+        self.path = path
+        self.handle = handle
+        return handle
+
+    def write(self, path, obs):
+        self.open(path)
+        obs.write()
+        self.written[path] = self.written.get(path, 0) + 1
+
+    def write_spectrum(self, dest_dir, spectrum):
+        path = os.path.join(dest_dir, output_file_name(spectrum.mjd,
+                                                       spectrum.source_name))
+        self.write(path, class_observation(spectrum))
+        return path
+
+    def close(self):
+        if self.handle is not None:
+            logger.debug("close file %s" % (self.path,))
+            self.handle.close()
+        self.path = None
+        self.handle = None
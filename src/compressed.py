@@ -0,0 +1,152 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import io
+import os
+import gzip
+import struct
+import logging
+import threading
+logger = logging.getLogger(__name__)
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .scancycle import DEFAULT_MEMORY_BUDGET
+
+GZIP_EXTENSION = ".gz"
+#tile compressed .fz files are read by astropy as they are, gzip files are
+#decompressed in memory by Decompressor
+COMPRESSED_EXTENSIONS = (".fits.gz", ".fz")
+#zlib releases the GIL, threads decompress on several cores
+DEFAULT_DECOMPRESS_THREADS = 4
+
+
+def is_gzip(path):
+    return path.endswith(GZIP_EXTENSION)
+
+def gunzip(path):
+    """
+    @return: the decompressed content of a gzip file
+    """
+    with open(path, "rb") as compressed:
+        return gzip.decompress(compressed.read())
+
+def gunzipped_size(path):
+    """
+    @return: the decompressed size of a gzip file, from its trailer, never
+    less than the compressed size
+    """
+    with open(path, "rb") as compressed:
+        compressed.seek(-4, os.SEEK_END)
+        #modulo 4 GiB, and only of the last member
+        size = struct.unpack("<I", compressed.read(4))[0]
+    return max(size, os.path.getsize(path))
+
+def read_row(path, offset, dtype):
+    """
+    Read a single table row from a gzip FITS file, decompressing the file
+    only up to the row
+    @param offset: row offset in the decompressed file
+    @param dtype: numpy dtype of a table row
+    """
+    import numpy as np
+    with gzip.open(path, "rb") as compressed:
+        compressed.seek(offset)
+        return np.frombuffer(compressed.read(dtype.itemsize), dtype)[0]
+
+
+class Decompressor(object):
+    """
+    Opens subscan files for reading their data. Gzip subscans are
+    decompressed into memory by a pool of threads: prefetched files are
+    decompressed ahead of their reduction, while previous ones are read.
+    At most max_bytes of decompressed files are held ahead of their
+    reading, files beyond are decompressed when opened.
+    """
+    def __init__(self, threads=DEFAULT_DECOMPRESS_THREADS,
+                 max_bytes=DEFAULT_MEMORY_BUDGET):
+        self.threads = threads
+        self.max_bytes = max_bytes
+        self.pool = None
+        #path -> (future of decompressed content, decompressed size)
+        self.pending = OrderedDict()
+        self.pending_bytes = 0
+        #cycles can be read by several threads
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        #converters are sent to worker processes before reading any data
+        return dict(threads = self.threads, max_bytes = self.max_bytes)
+
+    def __setstate__(self, state):
+        self.__init__(state["threads"], state["max_bytes"])
+
+    def prefetch(self, paths):
+        """
+        Start decompressing the gzip files among paths, in order, until
+        max_bytes are pending
+        """
+        with self.lock:
+            for path in paths:
+                if not is_gzip(path) or path in self.pending:
+                    continue
+                size = gunzipped_size(path)
+                #a single file is always decompressed ahead
+                if self.pending and self.pending_bytes + size > self.max_bytes:
+                    break
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(max(self.threads, 1))
+                self.pending[path] = (self.pool.submit(gunzip, path), size)
+                self.pending_bytes += size
+
+    def _pop(self, path):
+        future, size = self.pending.pop(path)
+        self.pending_bytes -= size
+        return future
+
+    def discard(self, paths):
+        """
+        Drop the pending decompressions of files which will not be read
+        """
+        with self.lock:
+            for path in paths:
+                if path in self.pending:
+                    self._pop(path).cancel()
+
+    def open(self, path):
+        """
+        @return: an HDUList, memory mapped for uncompressed files
+        """
+        from astropy.io import fits
+        if not is_gzip(path):
+            return fits.open(path, memmap=True)
+        with self.lock:
+            future = self._pop(path) if path in self.pending else None
+        if future is None:
+            return fits.open(io.BytesIO(gunzip(path)))
+        return fits.open(io.BytesIO(future.result()))
+
+    def close(self):
+        with self.lock:
+            for future, size in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.pending_bytes = 0
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
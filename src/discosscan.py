@@ -21,71 +21,176 @@ import logging
 logger = logging.getLogger(__name__)
 from datetime import datetime
 import sys
-import glob
+import math
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np 
 
-from astropy.io import fits
-from astropy import units as u
-from astropy.time import Time
-from astropy.constants import c as C
 
-import pyclassfiller
-from pyclassfiller import code
-
-from .scancycle import ScanCycle
+from .scancycle import ScanCycle, CycleAverage, POLARIZATIONS, ON
+from .scancycle import section_polarizations
+from .scancycle import DEFAULT_MEMORY_BUDGET
+from .subscanindex import load_subscan_index
+from .dutycycle import infer_duty_cycle, format_duty_cycle, ScanPlan
+from .switching import SwitchingScheme, ReferenceCache
+from .metadata import CycleMetadata, sidereal_times
+from .spectrum import ReducedSpectrum
+from .stats import ConversionStats
+from .compressed import COMPRESSED_EXTENSIONS, Decompressor
 
 
 #SUMMARY = "summary.fits"
 
 STOKES = "stokes"
-CLIGHT = C.to("km / s").value
 FILE_PREFIX = "class"
-FILE_EXTENSION = ".d2c"
 DATA_EXTENSION = ".fits"
+#cycles read ahead by background threads while the current one is reduced
+DEFAULT_PREFETCH_CYCLES = 2
+
+
+def is_data_file(file_name):
+    return file_name.endswith((DATA_EXTENSION,) + COMPRESSED_EXTENSIONS)
+
 
 class DiscosScanException(Exception):
     def __init__(self, message):
         super(DiscosScanException, self).__init__(message)
 
 class DiscosScanConverter(object):
-    def __init__(self, path=None, duty_cycle={}, skip_calibration=False):
-        self.SUMMARY=glob.glob(path+'?um*.fits')
+    def __init__(self, path=None, duty_cycle={}, skip_calibration=False,
+                 memory_budget=DEFAULT_MEMORY_BUDGET, average_cycles=1):
+        #summary file name, found by list_subscan_files
+        self.SUMMARY = None
         self.scan_path = path
         self.got_summary = False
-        self.file_class_out = pyclassfiller.ClassFileOut()
+        self.writer = None
+        self.manifest = None
         self.subscans = []
-        self.duty_cycle = duty_cycle
-        self.duty_cycle_size = sum(self.duty_cycle.values())
+        #a None duty cycle is inferred from SIGNAL headers by check_duty_cycle
+        self.auto_duty_cycle = duty_cycle is None
+        self.set_duty_cycle(duty_cycle or {})
+        #switching mode pairing on runs with shared references instead of
+        #the duty cycle, the SwitchingScheme is built by plan
+        self.switching_mode = None
+        self.switching = None
+        self.references = ReferenceCache()
         self.n_cycles = 0
+        #consecutive cycles averaged into each block of spectra, 0 for the
+        #whole scan
+        self.average_cycles = average_cycles
+        self.n_blocks = 0
         self.integration = 0
         self.skip_calibration = skip_calibration
+        self.memory_budget = memory_budget
+        self.stats = ConversionStats()
+        self.archive = None
+        #optional Resampler applied to reduced spectra
+        self.resampler = None
+        #optional RFIFlagging applied while reading data
+        self.flagging = None
+        self.decompressor = Decompressor(max_bytes=memory_budget)
+        #number of cycles read ahead in background, 0 reads synchronously
+        self.prefetch_cycles = DEFAULT_PREFETCH_CYCLES
+        self.reader = None
+        #cycle -> local sidereal time
+        self.sidereal_times = {}
+        #cycle -> future of (ScanCycle, read time)
+        self.prefetched = OrderedDict()
+
+    def set_duty_cycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.duty_cycle_size = sum(self.duty_cycle.values())
+
+    def list_subscan_files(self):
+        """
+        List the subscan files of the scan directory, also looking for the
+        summary file
+        @return: subscan file names
+        """
+        subscan_files = []
+        with os.scandir(self.scan_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.lower().startswith('sum'):
+                    self.SUMMARY = entry.name
+                    logger.debug("Summary File: %s" % self.SUMMARY)
+                elif is_data_file(entry.name):
+                    subscan_files.append(entry.name)
+        return subscan_files
 
     def load_subscans(self):
-        for subscan_file in os.listdir(self.scan_path):
-            ext = os.path.splitext(subscan_file)[-1]
-            if subscan_file.lower().startswith('sum'):
-                self.SUMMARY=subscan_file
-                logger.debug("Summary File: %s" % self.SUMMARY)
-                
-
-        
-            if not subscan_file == self.SUMMARY and ext == DATA_EXTENSION:
-                subscan_path = os.path.join(self.scan_path, subscan_file)
-                with fits.open(subscan_path) as subscan:
-                    self.subscans.append((subscan_path, 
-                                          subscan[0].header["SIGNAL"],
-                                          Time(subscan["DATA TABLE"].data["time"][0],
-                                               format = "mjd",
-                                               scale = "utc")
-                                         ))
-        #order file names by internal data timestamp
-        self.subscans.sort(key=lambda x:x[2])
-        logger.debug("ordered files: %s" % (str([filename for filename,_,_ in
+        with self.stats.stage("index"):
+            self.subscans = load_subscan_index(self.scan_path,
+                                               self.list_subscan_files())
+        self._count_indexed(self.subscans)
+        logger.debug("ordered files: %s" % (str([subscan.path for subscan in
                                                   self.subscans]),))
-        with fits.open(os.path.join(self.scan_path, self.SUMMARY)) as summary:
-            self.summary = summary[0].header
 
-    def convert_subscans(self, dest_dir=None):
+    def plan(self):
+        """
+        Group indexed subscans into cycles, inferring the duty cycle from
+        their SIGNAL headers in auto mode. No spectral data is read.
+        @return: a ScanPlan, or the SwitchingScheme in switching mode
+        """
+        if self.switching_mode:
+            try:
+                self.switching = SwitchingScheme(self.subscans,
+                                                 self.switching_mode)
+            except ValueError as e:
+                raise DiscosScanException("%s: cannot pair subscans: %s" %
+                                          (self.scan_path, e))
+            return self.switching
+        if self.auto_duty_cycle:
+            try:
+                self.set_duty_cycle(infer_duty_cycle([subscan.signal for
+                                                      subscan in self.subscans]))
+            except ValueError as e:
+                raise DiscosScanException("%s: cannot infer duty cycle: %s" %
+                                          (self.scan_path, e))
+            logger.debug("inferred duty cycle: %s" % (str(self.duty_cycle),))
+        return ScanPlan(self.subscans, self.duty_cycle)
+
+    def check_duty_cycle(self):
+        """
+        Validate the grouping of subscans into cycles before any spectral
+        data is read
+        @raise DiscosScanException: if a subscan SIGNAL does not match its
+        position in the duty cycle
+        """
+        plan = self.plan()
+        if plan.mismatches:
+            cycle, file_name, expected, signal = plan.mismatches[0]
+            raise DiscosScanException("%s: duty cycle %s does not match "
+                                      "subscan signals, cycle %d: %s is %s, "
+                                      "expected %s (%d mismatches)" %
+                                      (self.scan_path,
+                                       format_duty_cycle(self.duty_cycle),
+                                       cycle, file_name, signal, expected,
+                                       len(plan.mismatches)))
+        if plan.unknown:
+            logger.warning("%s: cannot check %d subscans with unknown SIGNAL" %
+                           (self.scan_path, len(plan.unknown)))
+        return plan
+
+    def _count_indexed(self, subscans):
+        self.stats.count("files_opened", len(subscans))
+        self.stats.count("bytes_read", sum(subscan.header_bytes
+                                           for subscan in subscans))
+
+    def add_subscans(self, subscan_files):
+        """
+        Add newly written subscan files to the index, used while following
+        a scan during acquisition
+        """
+        with self.stats.stage("index"):
+            subscans = load_subscan_index(self.scan_path, subscan_files)
+        self._count_indexed(subscans)
+        #a new list, cycles may be being read by background threads
+        self.subscans = sorted(self.subscans + subscans, key=lambda x:x.mjd)
+
+    def set_output(self, dest_dir=None, writer=None):
         self.dest_dir = dest_dir
         if not self.dest_dir:
             self.dest_dir = self.scan_path
@@ -96,222 +201,523 @@ class DiscosScanConverter(object):
                 if not os.path.isdir(self.dest_dir):
                     logger.error("cannot create output dir: %s" % (self.dest_dir,))
                     sys.exit(1)
-        for i in range(int(len(self.subscans) / self.duty_cycle_size)):
-            self.n_cycles += 1
-            scan_cycle = self.convert_cycle(i * self.duty_cycle_size)
-            self.write_observation(scan_cycle, i * self.duty_cycle_size) 
+        self.writer = writer
+
+    def set_archive(self, dest_dir, archive_format):
+        """
+        Collect reduced spectra in a columnar archive written to dest_dir
+        besides CLASS files
+        """
+        from .archive import ScanArchive, archive_path
+        self.archive = ScanArchive(archive_path(dest_dir, self.scan_path,
+                                                archive_format),
+                                   archive_format)
+
+    def write_archive(self):
+        if self.archive is not None:
+            with self.stats.stage("write"):
+                self.archive.write()
+
+    def reduction_options(self):
+        """
+        Options affecting the reduced spectra, recorded in the manifest
+        """
+        options = dict(duty_cycle = ("auto" if self.auto_duty_cycle
+                                     else self.duty_cycle),
+                       skip_calibration = self.skip_calibration)
+        if self.switching_mode:
+            options["switching"] = self.switching_mode
+            del options["duty_cycle"]
+        if self.average_cycles != 1:
+            options["average_cycles"] = self.average_cycles
+        if self.resampler:
+            options["resample"] = self.resampler.as_dict()
+        if self.flagging:
+            options["flagging"] = self.flagging.as_dict()
+        return options
+
+    def block_cycles(self, block):
+        """
+        @return: the range of the cycles found so far which are averaged
+        into a block; each cycle is a block of its own without averaging
+        """
+        if self.average_cycles == 0:
+            if block > 0:
+                return range(0)
+            return range(self.cycles_count)
+        start = block * self.average_cycles
+        return range(start, min(start + self.average_cycles,
+                                self.cycles_count))
+
+    def cycle_files(self, cycle):
+        """
+        Manifest records refer to blocks, which are single cycles without
+        averaging
+        @return: [file name, size, mtime] of the subscans of a block
+        """
+        indices = set()
+        for c in self.block_cycles(cycle):
+            indices.update(self.cycle_subscans(c))
+        return [[os.path.basename(subscan.path), subscan.size, subscan.mtime]
+                for subscan in (self.subscans[i] for i in sorted(indices))]
+
+    def cycle_done(self, cycle):
+        """
+        Check in the manifest, if any, if a block was already converted
+        """
+        return ((self.manifest is not None) and
+                self.manifest.cycle_done(self.scan_path, cycle,
+                                         self.cycle_files(cycle),
+                                         self.reduction_options()))
+
+    def check_options(self):
+        """
+        @raise DiscosScanException: if the manifest, if any, records
+        observations of this scan reduced with other options, which would be
+        written again
+        """
+        if self.manifest is None:
+            return
+        files = self.manifest.changed_options_files(self.scan_path,
+                                                    self.reduction_options())
+        if files:
+            raise DiscosScanException("%s: reduction options changed, "
+                                      "observations already written to %s "
+                                      "would be duplicated, use --force to "
+                                      "convert again" %
+                                      (self.scan_path, ", ".join(files)))
+
+    def record_cycle(self, cycle, observations):
+        if self.manifest is not None:
+            self.manifest.record_cycle(self.scan_path, cycle,
+                                       self.cycle_files(cycle), observations,
+                                       self.reduction_options())
+
+    def record_scan(self):
+        if self.manifest is not None:
+            self.manifest.record_scan(self.scan_path,
+                                      [[os.path.basename(subscan.path),
+                                        subscan.size, subscan.mtime]
+                                       for subscan in self.subscans],
+                                      self.reduction_options())
+
+    def convert_subscans(self, dest_dir=None, writer=None):
+        """
+        @param writer: a shared ClassWriter, when not given a new one is
+        created for this scan and closed when the conversion ends
+        """
+        from .classwriter import ClassWriter
+        own_writer = writer is None
+        if own_writer:
+            writer = ClassWriter()
+        self.set_output(dest_dir, writer)
+        if own_writer:
+            for path, count in self.count_observations(self.dest_dir).items():
+                writer.reserve(path, count)
+        try:
+            self.convert_pending_cycles(final=True)
+            self.write_archive()
+            if self.partial_cycle_subscans:
+                logger.warning("scan %s: ignoring %d subscans of an incomplete cycle" %
+                               (self.scan_path, self.partial_cycle_subscans))
+            self.record_scan()
+        finally:
+            if own_writer:
+                writer.close()
+            if self.manifest is not None:
+                self.manifest.flush()
+
+    def convert_pending_cycles(self, final=False):
+        """
+        Convert the complete cycles found in the subscan index which have
+        not been converted yet
+        @param final: the scan is complete, also convert a last block with
+        fewer cycles than the averaged ones
+        @return: the number of converted blocks
+        """
+        converted = 0
+        for cycle, spectra in self.reduce_pending_cycles(final):
+            observations = self.write_observations(spectra)
+            if self.archive is not None:
+                self.archive.add(spectra)
+            self.record_cycle(cycle, observations)
+            converted += 1
+        return converted
+
+    def reduce_pending_cycles(self, final=False):
+        """
+        Generator of the complete blocks of cycles found in the subscan
+        index which have not been reduced yet, cycles are read one at a time
+        or, with prefetch_cycles, also ahead by background threads
+        @param final: the scan is complete, also reduce a last block with
+        fewer cycles than the averaged ones
+        @return: (block number, list of ReducedSpectrum) tuples
+        """
+        try:
+            while True:
+                block = self.n_blocks
+                cycles = self.block_cycles(block)
+                if not cycles:
+                    break
+                if((not final) and
+                   ((self.average_cycles == 0) or
+                    (len(cycles) < self.average_cycles))):
+                    break
+                self.n_blocks += 1
+                self.n_cycles = cycles.stop
+                if self.cycle_done(block):
+                    logger.debug("%s: cycle %d already converted" %
+                                 (self.scan_path, block))
+                    for cycle in cycles:
+                        self._discard_cycle(cycle)
+                    continue
+                yield block, self.reduce_cycles(cycles, block)
+        finally:
+            if final:
+                self.close_readers()
+
+    @property
+    def partial_cycle_subscans(self):
+        if self.switching is not None:
+            return self.switching.partial_cycle_subscans
+        return len(self.subscans) % self.duty_cycle_size
 
-    def convert_cycle(self, index):
+    @property
+    def cycles_count(self):
+        if self.switching is not None:
+            return self.switching.cycles
+        return int(len(self.subscans) / self.duty_cycle_size)
+
+    def cycle_start(self, cycle):
+        """
+        @return: index of the first subscan of a cycle, an on subscan
+        """
+        if self.switching is not None:
+            return self.switching.on_runs[cycle].start
+        return cycle * self.duty_cycle_size
+
+    def cycle_subscans(self, cycle):
+        """
+        @return: indices of the subscans reduced into a cycle
+        """
+        if self.switching is not None:
+            return self.switching.cycle_subscans(cycle, self.reference_flags)
+        start = self.cycle_start(cycle)
+        return list(range(start, start + self.duty_cycle_size))
+
+    @property
+    def reference_flags(self):
+        if self.skip_calibration:
+            return ("off",)
+        return ("off", "cal")
+
+    def output_file_path(self, subscan, dest_dir):
+        from .classwriter import output_file_name
+        return os.path.join(dest_dir, output_file_name(subscan.mjd,
+                                                       subscan.source_name))
+
+    def count_observations(self, dest_dir):
+        """
+        Count the observations written by this scan, using only the
+        subscan index
+        @return: a dictionary of output file path -> observations count
+        """
+        counts = {}
+        block = 0
+        while self.block_cycles(block):
+            cycles = self.block_cycles(block)
+            block += 1
+            subscan = self.subscans[self.cycle_start(cycles.start)]
+            path = self.output_file_path(subscan, dest_dir)
+            count = sum(len(section_polarizations(section))
+                        for section in subscan.sections)
+            counts[path] = counts.get(path, 0) + count
+        return counts
+
+    def convert_cycle(self, cycle):
+        """
+        @return: the ScanCycle of a cycle, read by background threads when
+        prefetching is enabled. Stats are only updated by the calling
+        thread.
+        """
+        if self.prefetch_cycles:
+            scan_cycle, read_time = self._prefetched_cycle(cycle)
+        else:
+            scan_cycle, read_time = self._timed_read_cycle(cycle)
+        self.stats.add_time("read", read_time)
+        self.stats.count("files_opened", scan_cycle.files_opened)
+        self.stats.count("bytes_read", scan_cycle.bytes_read)
+        self.stats.count("flagged_rows", scan_cycle.flagged_rows)
+        self.stats.count("cycles")
+        return scan_cycle
+
+    def _prefetched_cycle(self, cycle):
+        """
+        Schedule the reading of a cycle and of the next prefetch_cycles
+        complete cycles, then wait for the first one. Cycles are always
+        returned in the requested order.
+        """
+        if self.reader is None:
+            self.reader = ThreadPoolExecutor(self.prefetch_cycles)
+        for queued in list(self.prefetched):
+            #skipped cycles
+            if queued < cycle:
+                self.prefetched.pop(queued).cancel()
+                self._discard_cycle(queued)
+        for queued in range(cycle, min(cycle + self.prefetch_cycles + 1,
+                                       self.cycles_count)):
+            if queued not in self.prefetched:
+                self.prefetched[queued] = self.reader.submit(
+                                            self._timed_read_cycle, queued)
+        return self.prefetched.pop(cycle).result()
+
+    def _discard_cycle(self, cycle):
+        """
+        Drop the decompressions prefetched for a cycle which is not read
+        """
+        self.decompressor.discard([self.subscans[i].path
+                                   for i in self.cycle_subscans(cycle)])
+
+    def close_readers(self):
+        for future in self.prefetched.values():
+            future.cancel()
+        self.prefetched.clear()
+        if self.reader is not None:
+            self.reader.shutdown()
+            self.reader = None
+        self.decompressor.close()
+        self.references.clear()
+
+    def _timed_read_cycle(self, cycle):
+        start = time.perf_counter()
+        if self.switching is not None:
+            scan_cycle = self._read_switched_cycle(cycle)
+        else:
+            scan_cycle = self._read_cycle(self.cycle_start(cycle))
+        return scan_cycle, time.perf_counter() - start
+
+    def _read_switched_cycle(self, cycle):
+        """
+        Read the on run of a cycle and take its off and cal spectra from
+        the reference runs it is paired with, reduced once and cached
+        """
+        run = self.switching.on_runs[cycle]
+        self.decompressor.prefetch([self.subscans[i].path for i in run.indices])
+        scan_cycle = ScanCycle(self.subscans[run.start].sections,
+                               dict(on = len(run)), self.flagging)
+        for i in run.indices:
+            with self.decompressor.open(self.subscans[i].path) as spec:
+                scan_cycle.add_data_file(spec, "on", self.memory_budget)
+        for flag in self.reference_flags:
+            pairs = self.switching.pairs(run, flag)
+            if not pairs:
+                continue
+            spectrum = 0.
+            integration = 0.
+            for ref, weight in pairs:
+                reference, reduced = self.references.get(ref.start,
+                                        lambda: self._read_reference(ref))
+                if reference.section_ids != scan_cycle.section_ids:
+                    raise DiscosScanException("scan %s: sections of %s "
+                                              "subscans %d-%d differ from "
+                                              "cycle %d" %
+                                              (self.scan_path, flag,
+                                               ref.indices[0], ref.indices[-1],
+                                               cycle))
+                if reduced:
+                    scan_cycle.files_opened += reference.files_opened
+                    scan_cycle.bytes_read += reference.bytes_read
+                    scan_cycle.flagged_rows += reference.flagged_rows
+                mean, ref_integration = reference.mean(flag)
+                spectrum = spectrum + weight * mean
+                integration = integration + weight * ref_integration
+            scan_cycle.set_reference(flag, spectrum, integration)
+        return scan_cycle
+
+    def _read_reference(self, run):
+        reference = ScanCycle(self.subscans[run.start].sections,
+                              {run.flag: len(run)}, self.flagging)
+        for i in run.indices:
+            with self.decompressor.open(self.subscans[i].path) as spec:
+                reference.add_data_file(spec, run.flag, self.memory_budget)
+        return reference
+
+    def _read_cycle(self, index):
+        #decompress this cycle and the next one while reading, within the
+        #memory budget
+        self.decompressor.prefetch([subscan.path for subscan in
+                                    self.subscans[index:index +
+                                                  2 * self.duty_cycle_size]])
         current_index = index
-        with fits.open(self.subscans[index][0]) as first_subscan:
-            scan_cycle = ScanCycle(first_subscan["SECTION TABLE"].data, 
-                                   self.duty_cycle)
+        scan_cycle = ScanCycle(self.subscans[index].sections, self.duty_cycle,
+                               self.flagging)
         for i in range(self.duty_cycle['on']):
-            with fits.open(self.subscans[current_index][0]) as spec:
-                scan_cycle.add_data_file(spec, "on")
+            with self.decompressor.open(self.subscans[current_index].path) as spec:
+                scan_cycle.add_data_file(spec, "on", self.memory_budget)
             current_index += 1
         for i in range(self.duty_cycle['off']):
-            with fits.open(self.subscans[current_index][0]) as spec:
-                scan_cycle.add_data_file(spec, "off")
+            with self.decompressor.open(self.subscans[current_index].path) as spec:
+                scan_cycle.add_data_file(spec, "off", self.memory_budget)
             current_index += 1
         for i in range(self.duty_cycle['cal']):
-            with fits.open(self.subscans[current_index][0]) as spec:
-                scan_cycle.add_data_file(spec, "cal")
+            with self.decompressor.open(self.subscans[current_index].path) as spec:
+                scan_cycle.add_data_file(spec, "cal", self.memory_budget)
             current_index += 1
         return scan_cycle
             
-    def _load_metadata(self, section, polarization, index):
-        with fits.open(self.subscans[index][0]) as subscan:
-            self.location = (subscan[0].header["SiteLongitude"] * u.rad,
-                        subscan[0].header["SiteLatitude"] * u.rad)
-            self.location = (self.location[0].to(u.deg),
-                             self.location[1].to(u.deg))
-            self.ra = subscan[0].header["RightAscension"]
-            self.dec = subscan[0].header["Declination"]
-            self.observation_time = Time(subscan["DATA TABLE"].data["time"][0],
-                                         format = "mjd",
-                                         scale = "utc", 
-                                         location = self.location)
-            self.azimut=subscan["DATA TABLE"].data["az"][0]
-            self.elevation=subscan["DATA TABLE"].data["el"][0]
-            weather_param=subscan["DATA TABLE"].data["weather"][0]
-            self.humidity=weather_param[0]  # relative umidity of the air
-            self.tamb=weather_param[1]      # air temperature in Celsius
-            self.pamb=weather_param[2]  #ambient pressure in millibar
-            
-            
-            
-	    
-	    
-            self.record_time = Time(subscan[0].header["DATE"], scale="utc")
-            self.antenna = subscan[0].header["ANTENNA"]
-            self.ScanID = subscan[0].header["SCANID"]
-            self.SubScanID = subscan[0].header["SubScanID"]
-            self.source_name = subscan[0].header["SOURCE"]
-            for sec in subscan["SECTION TABLE"].data:
-                if sec["id"] == section:
-                    self.bins = sec["bins"]
-                    self.bandwidth = sec["bandwidth"]
-            for rf in subscan["RF INPUTS"].data:
-                if((rf["polarization"] == polarization) and 
-                   (rf["section"] == section)):
-                    self.frequency = rf["frequency"]
-                    self.LO = rf["localOscillator"]
-                    try:
-                        self.calibrationMark = rf["calibrationMark"]
-                    except:
-                        #For retrocompatibility
-                        self.calibrationMark = rf["calibratonMark"]
-                    self.feed = rf["feed"]
-            self.freq_resolution = self.bandwidth / float(self.bins)
-
-            self.central_frequency = self.frequency + self.bandwidth / 2.0
-            try:
-                self.rest_frequency = self.summary["rest_frequency"][section]
-            except:
-                #Fallback procedure loading only first restfreq
-                logger.warning("using the same rest frequency for each section")
-                self.rest_frequency = self.summary["rest_frequency"][0]
-            offsetFrequencyAt0 = 0
-            if self.bins % 2 == 0:
-                self.central_channel = self.bins / 2
-                self.offsetFrequencyAt0 = -self.freq_resolution / 2.
-            else:
-                self.central_channel = (nchan / 2) + 1
-                self.offsetFrequencyAt0 = 0
-
-    def write_observation(self, scan_cycle, first_subscan_index):
-        onoffcal = scan_cycle.onoffcal()
-        for sec_id, v in scan_cycle.data.items():
-            for pol, data in v.items():
-                logger.debug("opened section %d pol %s" % (sec_id, pol))
-                self._load_metadata(sec_id, pol, first_subscan_index)
-
-                outputfilename = self.observation_time.datetime.strftime("%Y%j") + \
-                                 "_" + self.source_name +\
-                                 FILE_EXTENSION
-                output_file_path = os.path.join(self.dest_dir, outputfilename)
-                try: 
-                    logger.debug("try to open file %s" % (output_file_path,))
-                    self.file_class_out.open(output_file_path,
-                                             new = False,
-                                             over = False,
-                                             size = 999999,
-                                             single = False)
-                    logger.info("append observation to file %s" % (output_file_path,))
-                except:
-                    self.file_class_out.open(output_file_path,
-                                             new = True,
-                                             over = False,
-                                             size = 999999,
-                                             single = False)
-                    logger.info("open new file %s" % (output_file_path,))
-
-                obs = pyclassfiller.ClassObservation()
-                obs.head.presec[:]            = False  # Disable all sections except...
-                obs.head.presec[code.sec.gen] = True  # General
-                obs.head.presec[code.sec.pos] = True  # Position
-                obs.head.presec[code.sec.spe] = True  # Spectral observatins  Activate always spectral section to include the name of the line 
-                obs.head.presec[code.sec.cal] = True  # calibration observatins  Activate always spectral section to include the name of the line 
-
-                obs.head.gen.num = 0
-                obs.head.gen.ver = 0
-                obs.head.gen.teles = self.antenna
-                obs.head.gen.dobs = int(self.observation_time.mjd) - 60549
-                obs.head.gen.dred = int(self.record_time.mjd) - 60549
-                obs.head.gen.typec = code.coord.equ
-                obs.head.gen.kind = code.kind.spec
-                obs.head.gen.qual = code.qual.unknown
-                obs.head.gen.scan = self.ScanID
-                obs.head.gen.subscan = self.SubScanID
-                obs.head.gen.ut = (self.observation_time.mjd - int(self.observation_time.mjd)) * np.pi * 2
-                #FIXME: get sidereal time right
-                #obs.head.gen.st = observation_time.sidereal_time()
-                obs.head.gen.st = 0.
-                obs.head.gen.az = self.azimut  # unit radians
-                obs.head.gen.el = self.elevation # radians
-                obs.head.gen.tau = 0.
-                #FIXME: should we read antenna temperature?
-                obs.head.gen.time = data["on"][0]["integration"]
-                obs.head.gen.xunit = code.xunit.freq  # Unused
-
-                obs.head.pos.sourc = self.source_name
-                obs.head.pos.epoch = 2000.0
-                obs.head.pos.lam = self.ra
-                obs.head.pos.bet = self.dec
-                obs.head.pos.lamof = 0.
-                obs.head.pos.betof = 0.
-                obs.head.pos.proj = code.proj.none
-                obs.head.pos.sl0p = 0. #FIXME: ?	
-                obs.head.pos.sb0p = 0. #FIXME: ?	
-                obs.head.pos.sk0p = 0. #FIXME: ?
-   
-                obs.head.cal.tamb=float(self.tamb+273.15) # must be in K 
-                obs.head.cal.pamb=float(self.pamb)
-                
-                logger.debug("Air temperature  %f Air pressure %f" %  (self.tamb+273.15, self.pamb))
-
-                obs.head.spe.restf = self.rest_frequency
-                obs.head.spe.nchan = self.bins
-                obs.head.spe.rchan = self.central_channel
-                logger.debug("central channel  %f" %  self.central_channel)
-
-                obs.head.spe.fres = self.freq_resolution 
-
-                obs.head.spe.foff = self.offsetFrequencyAt0
-                logger.debug("offset at 0  %f" %  self.offsetFrequencyAt0)
-
-                obs.head.spe.vres = - (self.freq_resolution / self.central_frequency) * CLIGHT # frequency resolution must have the same unity like the central_frequency
-                obs.head.spe.voff = self.summary["velocity"]["vrad"]
-                obs.head.spe.bad = 0.
-                obs.head.spe.image = 0.
-                if self.summary["velocity"]["vframe"] == "BARY":
-                    logger.debug("velocity: HELIO")
-                    obs.head.spe.vtype = code.velo.helio
-                elif((self.summary["velocity"]["vframe"] == "LSRK") or
-                   (self.summary["velocity"]["vframe"] == "LSRD")):
-                    obs.head.spe.vtype = code.velo.lsr
-                    logger.debug("velocity: LSR")
-                elif self.summary["velocity"]["vframe"] == "TOPCEN":
-                    obs.head.spe.vtype = code.velo.obs
-                    logger.debug("velocity: OBS")
-                else:
-                    obs.head.spe.vtype = code.velo.unk
-                    logger.debug("velocity: UNK")
-                v_observer = -((self.central_frequency - self.rest_frequency) /
-                                          self.rest_frequency) * CLIGHT
-                obs.head.spe.doppler = -  (v_observer + obs.head.spe.voff) / CLIGHT #doppler in units of c light
-                                        #the negative sign is a class convention. 
-                logger.debug("Doppler  %f" %  obs.head.spe.doppler)
-                obs.head.spe.line = "SEC%d-%s" % (sec_id, pol)
-                on, off, cal = onoffcal[sec_id][pol]
-                if((not self.skip_calibration) and 
-                   (cal is not None)):
-                    start_bin = int(self.bins / 3)
-                    stop_bin = 2 * start_bin
-                    cal_mean = cal[start_bin:stop_bin].mean()
-                    off_mean = off[start_bin:stop_bin].mean()
-                    counts2kelvin = self.calibrationMark / (cal_mean - off_mean)
-                    logger.debug("c2k: %f" % (counts2kelvin,))
-                    tsys = counts2kelvin * off_mean
-                    obs.head.gen.tsys = tsys
-                    logger.debug("tsys: %f" % (tsys,))
-                    obs.datay = ((on - off) / off ) * tsys
-                else:
-                    logger.debug("skip calibration")
-                    obs.head.gen.tsys = 1. # ANTENNA TEMP TABLE is unknown
-                    obs.datay = (on - off) / off
-                obs.write()
-                self.file_class_out.close()
+    def _load_metadata(self, cycle):
+        """
+        @raise DiscosScanException: if a section polarization has no rf input
+        """
+        subscan = self.subscans[self.cycle_start(cycle)]
+        metadata = CycleMetadata(subscan, self.summary,
+                                 self._sidereal_time(cycle))
+        for section in subscan.sections:
+            for pol in section_polarizations(section):
+                if (section["id"], pol) not in metadata.spectra:
+                    raise DiscosScanException("scan %s: %s has no rf input "
+                                              "for section %d polarization %s" %
+                                              (self.scan_path,
+                                               os.path.basename(subscan.path),
+                                               section["id"], pol))
+        return metadata
+
+    def _sidereal_time(self, cycle):
+        """
+        Sidereal time of the start of a cycle. Sidereal times of every
+        complete cycle of the scan not computed yet are computed together
+        in one call and cached.
+        """
+        if cycle not in self.sidereal_times:
+            cycles = [c for c in range(self.cycles_count)
+                      if c not in self.sidereal_times]
+            if cycle not in cycles:
+                cycles.append(cycle)
+            subscan = self.subscans[self.cycle_start(cycle)]
+            times = sidereal_times([self.subscans[self.cycle_start(c)].mjd
+                                    for c in cycles],
+                                   math.degrees(subscan.site_longitude),
+                                   math.degrees(subscan.site_latitude))
+            self.sidereal_times.update(zip(cycles, times.tolist()))
+        return self.sidereal_times[cycle]
+
+    def reduce_cycle(self, scan_cycle, cycle, block=None):
+        """
+        Calibrate the spectra of a scan cycle
+        @param block: block number of the spectra, the cycle by default
+        @return: a list of ReducedSpectrum, one per section and polarization
+        """
+        with self.stats.stage("metadata"):
+            metadata = self._load_metadata(cycle)
+        spectra, tsys = self._calibrate(scan_cycle, metadata)
+        return self._reduced_spectra(scan_cycle, metadata, spectra, tsys,
+                                     scan_cycle.integration[ON],
+                                     cycle if block is None else block)
+
+    def reduce_cycles(self, cycles, block):
+        """
+        Calibrate the cycles of a block and average them weighting each
+        cycle by its integration time. Header values are taken from the
+        first cycle, while the integration time is the total one.
+        @return: a list of ReducedSpectrum, one per section and polarization
+        """
+        if len(cycles) == 1:
+            return self.reduce_cycle(self.convert_cycle(cycles.start),
+                                     cycles.start, block)
+        with self.stats.stage("metadata"):
+            metadata = self._load_metadata(cycles.start)
+        average = None
+        for cycle in cycles:
+            scan_cycle = self.convert_cycle(cycle)
+            if average is None:
+                average = CycleAverage(scan_cycle.section_ids)
+            elif scan_cycle.section_ids != average.section_ids:
+                raise DiscosScanException("scan %s: cannot average cycle %d, "
+                                          "sections changed" %
+                                          (self.scan_path, cycle))
+            spectra, tsys = self._calibrate(scan_cycle, metadata)
+            with self.stats.stage("calibration"):
+                average.add(spectra, tsys, scan_cycle.integration[ON])
+        spectra, tsys, integration = average.average()
+        logger.debug("%s: averaged cycles %d-%d" % (self.scan_path,
+                                                    cycles.start,
+                                                    cycles.stop - 1))
+        return self._reduced_spectra(scan_cycle, metadata, spectra, tsys,
+                                     integration, block)
+
+    def _calibrate(self, scan_cycle, metadata):
+        calibration_mark = None
+        if not self.skip_calibration:
+            calibration_mark = np.ones((len(scan_cycle.section_ids),
+                                        len(POLARIZATIONS)))
+            for sec_id, pol, s, p in scan_cycle.layout():
+                calibration_mark[s, p] = metadata[sec_id, pol].calibrationMark
+        with self.stats.stage("calibration"):
+            return scan_cycle.calibrate(calibration_mark)
+
+    def _reduced_spectra(self, scan_cycle, metadata, spectra, tsys,
+                         integration, block):
+        layout = scan_cycle.layout()
+        self.stats.count("spectra", len(layout))
+        resampled = {}
+        if self.resampler:
+            #all polarizations of a section at once
+            for s, sec_id in enumerate(scan_cycle.section_ids):
+                resampled[s] = self.resampler.apply(
+                                   spectra[s, :, :scan_cycle.bins[s]], sec_id)
+        reduced = []
+        for sec_id, pol, s, p in layout:
+            logger.debug("opened section %d pol %s" % (sec_id, pol))
+            spectrum = metadata[sec_id, pol]
+            reduced_spectrum = ReducedSpectrum(metadata, spectrum, self.summary,
+                                               sec_id, pol,
+                                               integration[s],
+                                               spectra[s, p, :scan_cycle.bins[s]],
+                                               tsys[s, p],
+                                               block)
+            if s in resampled:
+                data, first_channel, factor = resampled[s]
+                reduced_spectrum.resampled(data[p], first_channel, factor)
+            reduced.append(reduced_spectrum)
+        return reduced
+
+    def reduce_scan(self):
+        """
+        Generator of the reduced spectra of the whole scan, one cycle at a
+        time
+        """
+        for cycle, spectra in self.reduce_pending_cycles(final=True):
+            for spectrum in spectra:
+                yield spectrum
+
+    def write_observations(self, spectra):
+        """
+        Write reduced spectra as CLASS observations
+        @return: dictionary of output file name -> written observations
+        """
+        observations = {}
+        for spectrum in spectra:
+            with self.stats.stage("write"):
+                path = self.writer.write_spectrum(self.dest_dir, spectrum)
+            self.stats.count("observations")
+            file_name = os.path.basename(path)
+            observations[file_name] = observations.get(file_name, 0) + 1
+        return observations
 
     def load_summary_info(self, summary_file_path=None):
+        from astropy.io import fits
         if not summary_file_path:
-            dir_name = self.scan_path
-        summary_file_path = os.path.join(dir_name, self.SUMMARY)
+            if self.SUMMARY is None:
+                self.list_subscan_files()
+            if self.SUMMARY is None:
+                raise DiscosScanException("scan %s does not contain a summary file" %
+                                          (self.scan_path,))
+            summary_file_path = os.path.join(self.scan_path, self.SUMMARY)
         if not os.path.exists(summary_file_path):
-            raise DiscosScanException("scan %s does not conatain a %s" % (dir_name,
-                                                                          self.SUMMARY))
-        with fits.open(summary_file_path) as summary_file:
+            raise DiscosScanException("summary file %s does not exist" %
+                                      (summary_file_path,))
+        with self.stats.stage("summary"), fits.open(summary_file_path) as summary_file:
+            self.stats.count("files_opened")
             logger.debug("loading summary from %s" % (summary_file_path,))
             summary_header = summary_file[0].header
             rest_frequency = []
@@ -0,0 +1,145 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import fnmatch
+import logging
+logger = logging.getLogger(__name__)
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .discosscan import is_data_file
+
+#directory listing is I/O bound, threads overlap the latency of each call
+DEFAULT_SCAN_THREADS = 16
+
+
+def _scan_directory(path):
+    """
+    List a directory with a single os.scandir call
+    @return: (path, is a scan, first subscan file name, subdirectories);
+    subdirectories of scans are not returned
+    """
+    subdirs = []
+    subscans = []
+    has_summary = False
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif is_data_file(entry.name):
+                    if entry.name.lower().startswith("sum"):
+                        has_summary = True
+                    else:
+                        subscans.append(entry.name)
+    except OSError as e:
+        logger.warning("cannot list %s: %s" % (path, e))
+    if has_summary:
+        return path, True, min(subscans) if subscans else None, []
+    return path, False, None, subdirs
+
+def parse_date(date):
+    """
+    @param date: "YYYY-MM-DD" string
+    """
+    return datetime.strptime(date, "%Y-%m-%d").date()
+
+
+class ScanFilter(object):
+    """
+    Selects scans by glob pattern on their path relative to the archive
+    root, by source name and by observation date. Source names and dates
+    are read from the primary header of the first subscan, only when
+    needed.
+    """
+    def __init__(self, since=None, until=None, sources=None, pattern=None):
+        self.since = since
+        self.until = until
+        self.sources = None
+        if sources:
+            self.sources = set(source.lower() for source in sources)
+        self.pattern = pattern
+
+    @property
+    def needs_header(self):
+        return bool(self.since or self.until or self.sources)
+
+    def match_path(self, root, scan_path):
+        if self.pattern is None:
+            return True
+        return fnmatch.fnmatch(os.path.relpath(scan_path, root), self.pattern)
+
+    def match_header(self, scan_path, subscan_file):
+        if not self.needs_header:
+            return True
+        if subscan_file is None:
+            return False
+        from astropy.io import fits
+        try:
+            header = fits.getheader(os.path.join(scan_path, subscan_file), 0)
+            date = parse_date(header["DATE"].strip()[:10])
+            source = header["SOURCE"].strip().lower()
+        except Exception as e:
+            logger.warning("cannot read %s in %s: %s" % (subscan_file,
+                                                         scan_path, e))
+            return False
+        if self.since and date < self.since:
+            return False
+        if self.until and date > self.until:
+            return False
+        if self.sources and source not in self.sources:
+            return False
+        return True
+
+
+def find_scans(roots, scan_filter=None, threads=DEFAULT_SCAN_THREADS):
+    """
+    Recursively find DISCOS scan directories, the ones holding a summary
+    file, below archive roots. Directories are listed in parallel and scan
+    directories are not descended into.
+    @param scan_filter: optional ScanFilter selecting the scans
+    @return: sorted list of scan directory paths
+    """
+    found = []
+    with ThreadPoolExecutor(threads) as pool:
+        #each pending listing is mapped to the root it was found under
+        pending = {}
+        for root in roots:
+            root = os.path.normpath(root)
+            pending[pool.submit(_scan_directory, root)] = root
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                root = pending.pop(future)
+                path, is_scan, subscan_file, subdirs = future.result()
+                if is_scan:
+                    found.append((root, path, subscan_file))
+                for subdir in subdirs:
+                    pending[pool.submit(_scan_directory, subdir)] = root
+        logger.info("found %d scans" % (len(found),))
+        if scan_filter is not None:
+            found = [scan for scan in found
+                     if scan_filter.match_path(scan[0], scan[1])]
+            if scan_filter.needs_header:
+                selected = pool.map(lambda scan: scan_filter.match_header(
+                                                    scan[1], scan[2]),
+                                    found)
+                found = [scan for scan, ok in zip(found, selected) if ok]
+            logger.info("%d scans selected" % (len(found),))
+    return sorted(scan[1] for scan in found)
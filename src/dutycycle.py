@@ -0,0 +1,106 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+#duty cycle flags in the order subscans are acquired in each cycle
+FLAGS = ["on", "off", "cal"]
+#SIGNAL header values written by DISCOS for each duty cycle flag
+SIGNAL_FLAGS = dict(SIGNAL = "on", REFERENCE = "off", REFCAL = "cal")
+
+
+def signal_flag(signal):
+    """
+    @return: the duty cycle flag of a SIGNAL header value, None if unknown
+    """
+    return SIGNAL_FLAGS.get(str(signal).strip().upper())
+
+def format_duty_cycle(duty_cycle):
+    return "%d:%d:%d" % (duty_cycle["on"], duty_cycle["off"], duty_cycle["cal"])
+
+def infer_duty_cycle(signals):
+    """
+    Infer the duty cycle from the SIGNAL headers of the subscans of a scan,
+    in acquisition order, as the lengths of the leading runs of on, off and
+    cal subscans
+    @return: duty cycle dictionary
+    @raise ValueError: if the signals do not describe a duty cycle
+    """
+    flags = [signal_flag(signal) for signal in signals]
+    if None in flags:
+        raise ValueError("unknown SIGNAL %s" % (signals[flags.index(None)],))
+    duty_cycle = dict((flag, 0) for flag in FLAGS)
+    i = 0
+    for flag in FLAGS:
+        while i < len(flags) and flags[i] == flag:
+            duty_cycle[flag] += 1
+            i += 1
+    if not duty_cycle["on"] or not duty_cycle["off"]:
+        raise ValueError("scan does not start with on and off subscans: %s" %
+                         (" ".join(flags[:8]),))
+    return duty_cycle
+
+
+class ScanPlan(object):
+    """
+    Grouping of the subscans of a scan into cycles of a duty cycle, checked
+    against their SIGNAL headers
+      - mismatches: (cycle, file name, expected flag, SIGNAL) of the
+        subscans whose SIGNAL does not match their position in the cycle
+      - unknown: file names of subscans with an unknown SIGNAL, which
+        cannot be checked
+    """
+    def __init__(self, subscans, duty_cycle):
+        self.duty_cycle = duty_cycle
+        size = sum(duty_cycle.values())
+        self.subscans = len(subscans)
+        self.cycles = self.subscans // size if size else 0
+        self.partial_cycle_subscans = self.subscans - self.cycles * size
+        expected = []
+        for flag in FLAGS:
+            expected.extend([flag] * duty_cycle.get(flag, 0))
+        self.mismatches = []
+        self.unknown = []
+        for i, subscan in enumerate(subscans[:self.cycles * size]):
+            file_name = os.path.basename(subscan.path)
+            flag = signal_flag(subscan.signal)
+            if flag is None:
+                self.unknown.append(file_name)
+            elif flag != expected[i % size]:
+                self.mismatches.append((i // size, file_name,
+                                        expected[i % size], subscan.signal))
+
+    @property
+    def valid(self):
+        return self.cycles > 0 and not self.mismatches
+
+    def log(self, scan_path):
+        logger.info("%s: %d subscans, duty cycle %s, %d cycles" %
+                    (scan_path, self.subscans,
+                     format_duty_cycle(self.duty_cycle), self.cycles))
+        if self.partial_cycle_subscans:
+            logger.warning("%s: last %d subscans do not complete a cycle" %
+                           (scan_path, self.partial_cycle_subscans))
+        for cycle, file_name, expected, signal in self.mismatches:
+            logger.error("%s: cycle %d, %s is %s, expected %s" %
+                         (scan_path, cycle, file_name, signal, expected))
+        if self.unknown:
+            logger.warning("%s: cannot check %d subscans with unknown SIGNAL" %
+                           (scan_path, len(self.unknown)))
@@ -0,0 +1,137 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from .resample import parse_channel_range
+from .scancycle import DEFAULT_MEMORY_BUDGET, chunked_sum
+
+#scale factor from median absolute deviation to gaussian sigma
+MAD_TO_SIGMA = 1.4826
+#fewer rows give no meaningful median
+MIN_CLIP_ROWS = 3
+
+
+def load_channel_mask(path):
+    """
+    Read a channel mask file, with a "[section=]start:stop" range of
+    channels per line, counted from 0 with stop excluded. Empty lines and
+    lines starting with # are ignored.
+    @return: dictionary of section id, None for every section -> list of
+    (start, stop)
+    """
+    ranges = {}
+    with open(path) as mask_file:
+        for line in mask_file:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            for section, channels in parse_channel_range([line]).items():
+                ranges.setdefault(section, []).append(channels)
+    return ranges
+
+
+class RFIFlagging(object):
+    """
+    Row and channel flagging applied while subscan data is summed:
+      - rows (dumps) whose total power, in any polarization, is more than
+        sigma standard deviations away from the median of the subscan are
+        dropped, and are not counted in samples and integration time. The
+        standard deviation of total power is estimated from its median
+        absolute deviation.
+      - channels of a static mask are blanked in reduced spectra and are
+        not used to measure tsys
+    """
+    def __init__(self, sigma=None, channel_ranges=None):
+        self.sigma = sigma
+        self.channel_ranges = channel_ranges or {}
+
+    def __bool__(self):
+        return bool(self.sigma or self.channel_ranges)
+
+    def channel_mask(self, section_id, bins):
+        """
+        @return: boolean array of bins channels, True for masked channels
+        """
+        mask = np.zeros(bins, dtype=bool)
+        for start, stop in (self.channel_ranges.get(None, []) +
+                            self.channel_ranges.get(section_id, [])):
+            mask[start:stop] = True
+        return mask
+
+    def clipped_sum(self, data, n_pols, bins,
+                    memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Sum the rows of a subscan data column like chunked_sum, clipping
+        them on their total power in the same pass. The standard deviation
+        of total power is the robust scatter of the rows, so that gain drifts
+        common to every channel are not flagged, but never less than the
+        noise of independent channels, estimated from the lower quartile of
+        the differences of adjacent rows, which keeps subscans of few dumps
+        from being over flagged. Rejected rows are read again to be
+        subtracted from the sum.
+        @return: (float64 array of n_pols * bins channels, number of summed
+        rows)
+        """
+        width = n_pols * bins
+        if not self.sigma or len(data) < MIN_CLIP_ROWS:
+            return chunked_sum(data, width, memory_budget)
+        #rows are converted to float64 and differenced in each chunk
+        row_bytes = max(1, width * (data.dtype.itemsize + 2 * 8))
+        chunk_rows = max(1, int(memory_budget // row_bytes))
+        total = np.zeros(width)
+        power = np.empty((len(data), n_pols))
+        noise = np.empty((len(data) - 1, n_pols))
+        previous = None
+        for start in range(0, len(data), chunk_rows):
+            chunk = np.asarray(data[start:start + chunk_rows, :width],
+                               dtype=np.float64)
+            total += chunk.sum(0)
+            power[start:start + len(chunk)] = \
+                chunk.reshape(len(chunk), n_pols, bins).sum(-1)
+            if previous is not None:
+                noise[start - 1] = ((chunk[0] - previous) ** 2).reshape(
+                                        n_pols, bins).sum(-1) / 2.
+            difference = np.diff(chunk, axis=0)
+            np.square(difference, out=difference)
+            noise[start:start + len(difference)] = difference.reshape(
+                                len(difference), n_pols, bins).sum(-1) / 2.
+            previous = chunk[-1].copy()
+            del chunk, difference
+        deviation = np.abs(power - np.median(power, axis=0))
+        #an outlier spoils both differences it takes part in, the lower
+        #quartile stays clean even with few rows
+        scale = np.maximum(MAD_TO_SIGMA * np.median(deviation, axis=0),
+                           np.sqrt(np.percentile(noise, 25, axis=0)))
+        outliers = ((deviation > self.sigma * scale) & (scale > 0)).any(-1)
+        rejected = np.flatnonzero(outliers)
+        for start in range(0, len(rejected), chunk_rows):
+            rows = rejected[start:start + chunk_rows]
+            total -= np.asarray(data[rows, :width], dtype=np.float64).sum(0)
+        return total, len(data) - len(rejected)
+
+    def as_dict(self):
+        """
+        JSON serializable description, recorded in the manifest
+        """
+        return dict(sigma = self.sigma,
+                    channel_mask = dict((str(k), [list(r) for r in v])
+                                        for k, v in self.channel_ranges.items()))
@@ -0,0 +1,198 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "discos2class_manifest.json"
+#records appended since the manifest was last saved
+JOURNAL_NAME = "discos2class_manifest.journal"
+MANIFEST_VERSION = 1
+
+
+def file_stat(path):
+    """
+    @return: [file name, size, mtime] identifying a version of an input file
+    """
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime]
+
+
+class ConversionManifest(object):
+    """
+    Persistent record of the conversions written to an output directory.
+    For every scan it stores the reduction options, and for every cycle
+    the input subscan files with their size and mtime together with the
+    observations written, so that a new run can skip unchanged scans and
+    cycles and resume an interrupted conversion. Every record is appended
+    to a journal as soon as it is made, so that it survives a killed
+    process; the journal is folded into the manifest when a scan is
+    complete and by flush().
+    """
+    def __init__(self, dest_dir):
+        self.path = os.path.join(dest_dir, MANIFEST_NAME)
+        self.journal_path = os.path.join(dest_dir, JOURNAL_NAME)
+        self.scans = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as manifest_file:
+                    content = json.load(manifest_file)
+                if content.get("version") == MANIFEST_VERSION:
+                    self.scans = content["scans"]
+                else:
+                    logger.warning("ignoring manifest %s with version %s" %
+                                   (self.path, content.get("version")))
+            except ValueError as e:
+                logger.warning("ignoring corrupted manifest %s: %s" %
+                               (self.path, e))
+        if os.path.exists(self.journal_path):
+            self._replay()
+
+    @staticmethod
+    def scan_key(scan_path):
+        return os.path.abspath(scan_path)
+
+    def _replay(self):
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #last record of a killed process
+                    logger.warning("ignoring truncated record in %s" %
+                                   (self.journal_path,))
+                    continue
+                self._apply(entry)
+                self.dirty = True
+
+    def _apply(self, entry):
+        if entry.get("forget"):
+            self.scans.pop(entry["scan"], None)
+            return
+        scan = self._scan(entry["scan"], entry["options"])
+        if "cycle" in entry:
+            scan["cycles"][str(entry["cycle"])] = dict(
+                                    files = entry["files"],
+                                    observations = entry["observations"])
+            scan["files"] = None
+        else:
+            scan["files"] = sorted(entry["files"])
+
+    def _record(self, entry):
+        """
+        Apply a record and append it to the journal
+        """
+        self._apply(entry)
+        with open(self.journal_path, "a") as journal:
+            journal.write(json.dumps(entry, sort_keys=True) + "\n")
+        self.dirty = True
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(dict(version = MANIFEST_VERSION,
+                           scans = self.scans),
+                      manifest_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        #replaying the journal again on the saved manifest is harmless
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.dirty = False
+
+    def flush(self):
+        """
+        Fold the journal into the manifest
+        """
+        if self.dirty:
+            self.save()
+
+    def _scan(self, key, options):
+        """
+        @return: the record of a scan, reset when reduction options changed
+        """
+        scan = self.scans.get(key)
+        if scan is None or scan["options"] != options:
+            scan = dict(options = options, cycles = {}, files = None)
+            self.scans[key] = scan
+        return scan
+
+    def forget(self, scan_path):
+        """
+        Drop the records of a scan, which will be converted again
+        """
+        key = self.scan_key(scan_path)
+        if key in self.scans:
+            self._record(dict(scan = key, forget = True))
+
+    def scan_done(self, scan_path, subscan_files, options):
+        """
+        Check if a scan was completely converted with the same options and
+        its subscan files did not change since, without reading them
+        """
+        scan = self.scans.get(self.scan_key(scan_path))
+        if scan is None or scan["options"] != options or not scan["files"]:
+            return False
+        files = sorted(file_stat(os.path.join(scan_path, f))
+                       for f in subscan_files)
+        return files == scan["files"]
+
+    def changed_options_files(self, scan_path, options):
+        """
+        @return: sorted names of the output files holding observations of a
+        scan converted with reduction options other than the given ones
+        """
+        scan = self.scans.get(self.scan_key(scan_path))
+        if scan is None or scan["options"] == options:
+            return []
+        files = set()
+        for record in scan["cycles"].values():
+            files.update(record["observations"])
+        return sorted(files)
+
+    def cycle_done(self, scan_path, cycle, files, options):
+        scan = self.scans.get(self.scan_key(scan_path))
+        if scan is None or scan["options"] != options:
+            return False
+        record = scan["cycles"].get(str(cycle))
+        if record is None:
+            return False
+        if record["files"] != files:
+            logger.warning("%s: cycle %d input files changed, observations "
+                           "already written to %s are kept" %
+                           (scan_path, cycle, ", ".join(record["observations"])))
+            return False
+        return True
+
+    def record_cycle(self, scan_path, cycle, files, observations, options):
+        """
+        @param observations: dictionary of output file name -> observations
+        """
+        self._record(dict(scan = self.scan_key(scan_path), options = options,
+                          cycle = cycle, files = files,
+                          observations = observations))
+
+    def record_scan(self, scan_path, files, options):
+        """
+        Mark a scan as completely converted from the given subscan files
+        """
+        self._record(dict(scan = self.scan_key(scan_path), options = options,
+                          files = files))
+        self.save()
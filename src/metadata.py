@@ -0,0 +1,142 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import logging
+logger = logging.getLogger(__name__)
+from datetime import datetime, timedelta
+
+from .scancycle import section_polarizations
+
+MJD_EPOCH = datetime(1858, 11, 17)
+
+
+def mjd2datetime(mjd):
+    """
+    Plain float conversion of a UTC MJD, good enough to get the date of an
+    observation without building astropy Time objects
+    """
+    return MJD_EPOCH + timedelta(days=mjd)
+
+def date2mjd(date):
+    """
+    MJD of the day of an ISO formatted UTC date such as a FITS DATE keyword
+    """
+    day = datetime.strptime(date.strip()[:10], "%Y-%m-%d")
+    return float((day - MJD_EPOCH).days)
+
+
+def sidereal_times(mjds, longitude, latitude):
+    """
+    Apparent local sidereal times of many UTC MJDs in a single vectorized
+    astropy call
+    @param longitude, latitude: site coordinates in degrees
+    @return: numpy array of sidereal times in radians
+    """
+    from astropy.time import Time
+    from astropy.coordinates import EarthLocation
+    from astropy.utils.iers import IERSRangeError
+    import astropy.units as u
+    times = Time(mjds, format="mjd", scale="utc",
+                 location=EarthLocation.from_geodetic(longitude * u.deg,
+                                                      latitude * u.deg))
+    try:
+        return times.sidereal_time("apparent").rad
+    except IERSRangeError as e:
+        logger.warning("%s: using UT1 = UTC for sidereal time" % (e,))
+        times.delta_ut1_utc = 0.
+        return times.sidereal_time("apparent").rad
+
+
+class SpectrumMetadata(object):
+    """
+    Spectral setup of a single section and polarization
+    """
+    def __init__(self, section, rf_input, rest_frequency):
+        self.bins = section["bins"]
+        self.bandwidth = section["bandwidth"]
+        self.frequency = rf_input["frequency"]
+        self.LO = rf_input["localOscillator"]
+        try:
+            self.calibrationMark = rf_input["calibrationMark"]
+        except KeyError:
+            #For retrocompatibility
+            self.calibrationMark = rf_input["calibratonMark"]
+        self.feed = rf_input["feed"]
+        self.rest_frequency = rest_frequency
+        self.freq_resolution = self.bandwidth / float(self.bins)
+        self.central_frequency = self.frequency + self.bandwidth / 2.0
+        if self.bins % 2 == 0:
+            self.central_channel = self.bins / 2
+            self.offsetFrequencyAt0 = -self.freq_resolution / 2.
+        else:
+            self.central_channel = (self.bins // 2) + 1
+            self.offsetFrequencyAt0 = 0
+
+
+class CycleMetadata(object):
+    """
+    Metadata shared by every spectrum of a scan cycle, built once from the
+    first subscan of the cycle. Spectral setups are looked up by
+    (section, polarization) keys.
+    """
+    def __init__(self, subscan, summary, sidereal_time=0.):
+        #site longitude and latitude in degrees
+        self.location = (math.degrees(subscan.site_longitude),
+                         math.degrees(subscan.site_latitude))
+        self.ra = subscan.ra
+        self.dec = subscan.dec
+        #UTC MJD of the first data row
+        self.observation_mjd = subscan.mjd
+        #local sidereal time of observation_mjd in radians
+        self.sidereal_time = sidereal_time
+        self.azimut = subscan.azimut
+        self.elevation = subscan.elevation
+        weather_param = subscan.weather
+        self.humidity=weather_param[0]  # relative umidity of the air
+        self.tamb=weather_param[1]      # air temperature in Celsius
+        self.pamb=weather_param[2]  #ambient pressure in millibar
+        #UTC MJD of the day the subscan was recorded
+        self.record_mjd = date2mjd(subscan.date)
+        self.antenna = subscan.antenna
+        self.ScanID = subscan.scan_id
+        self.SubScanID = subscan.subscan_id
+        self.source_name = subscan.source_name
+        self.spectra = {}
+        rf_inputs = {}
+        for rf in subscan.rf_inputs:
+            rf_inputs[(rf["section"], rf["polarization"])] = rf
+            #simple sections use the first rf input of the section
+            rf_inputs.setdefault((rf["section"], "simple"), rf)
+        for sec in subscan.sections:
+            try:
+                rest_frequency = summary["rest_frequency"][sec["id"]]
+            except IndexError:
+                #Fallback procedure loading only first restfreq
+                logger.warning("using the same rest frequency for each section")
+                rest_frequency = summary["rest_frequency"][0]
+            for pol in section_polarizations(sec):
+                rf = rf_inputs.get((sec["id"], pol))
+                if rf is None:
+                    #reported by the converter with the scan name
+                    continue
+                self.spectra[(sec["id"], pol)] = SpectrumMetadata(sec, rf,
+                                                           rest_frequency)
+
+    def __getitem__(self, key):
+        return self.spectra[key]
@@ -0,0 +1,114 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+valid_rebin = re.compile("^(?:(?P<section>\d+)=)?(?P<factor>\d+)$")
+valid_channel_range = re.compile("^(?:(?P<section>\d+)=)?(?P<start>\d+):(?P<stop>\d+)$")
+
+
+def rebin(data, factor):
+    """
+    Average groups of factor adjacent channels along the last axis,
+    trailing channels not filling a group are dropped
+    """
+    if factor == 1:
+        return data
+    channels = data.shape[-1] // factor
+    return data[..., :channels * factor].reshape(data.shape[:-1] +
+                                                 (channels, factor)).mean(-1)
+
+def _section(match):
+    if match.group("section") is None:
+        return None
+    return int(match.group("section"))
+
+def parse_rebin(values):
+    """
+    @param values: list of "[section=]factor" strings
+    @return: dictionary of section id, None for every section -> factor
+    """
+    factors = {}
+    for value in values or []:
+        m = valid_rebin.match(value)
+        if not m or int(m.group("factor")) < 1:
+            raise ValueError("Invalid rebin factor: %s" % (value,))
+        factors[_section(m)] = int(m.group("factor"))
+    return factors
+
+def parse_channel_range(values):
+    """
+    @param values: list of "[section=]start:stop" strings, channels are
+    counted from 0 and stop is excluded
+    @return: dictionary of section id, None for every section -> (start, stop)
+    """
+    ranges = {}
+    for value in values or []:
+        m = valid_channel_range.match(value)
+        if not m or int(m.group("start")) >= int(m.group("stop")):
+            raise ValueError("Invalid channel range: %s" % (value,))
+        ranges[_section(m)] = (int(m.group("start")), int(m.group("stop")))
+    return ranges
+
+
+class Resampler(object):
+    """
+    Per section channel selection and rebinning of reduced spectra. Options
+    given for section None apply to every section without its own.
+    """
+    def __init__(self, channel_ranges=None, rebin_factors=None):
+        self.channel_ranges = channel_ranges or {}
+        self.rebin_factors = rebin_factors or {}
+
+    def __bool__(self):
+        return bool(self.channel_ranges or self.rebin_factors)
+
+    def _get(self, options, section_id, default):
+        return options.get(section_id, options.get(None, default))
+
+    def setup(self, section_id, bins):
+        """
+        @return: (start, stop, factor) for a section with the given bins
+        """
+        start, stop = self._get(self.channel_ranges, section_id, (0, bins))
+        stop = min(stop, bins)
+        factor = self._get(self.rebin_factors, section_id, 1)
+        if stop - start < factor:
+            raise ValueError("section %d: channel range %d:%d of %d bins "
+                             "leaves no channels to rebin by %d" %
+                             (section_id, start, stop, bins, factor))
+        return start, stop, factor
+
+    def apply(self, data, section_id):
+        """
+        @param data: spectra of a section, channels along the last axis
+        @return: (resampled data, first selected channel, rebin factor)
+        """
+        start, stop, factor = self.setup(section_id, data.shape[-1])
+        return rebin(data[..., start:stop], factor), start, factor
+
+    def as_dict(self):
+        """
+        JSON serializable description, recorded in the manifest
+        """
+        return dict(channel_range = dict((str(k), list(v)) for k, v in
+                                         self.channel_ranges.items()),
+                    rebin = dict((str(k), v) for k, v in
+                                 self.rebin_factors.items()))
@@ -4,77 +4,268 @@ logger = logging.getLogger(__name__)
 import numpy as np
 
 POLARIZATIONS = ["LCP", "RCP"]
+FLAGS = ["on", "off", "cal"]
+ON, OFF, CAL = list(range(len(FLAGS)))
+#maximum number of bytes of a data column read at once
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+def section_polarizations(section):
+    if section["type"] == "simple":
+        return ["simple"]
+    else:
+        return POLARIZATIONS
+
+def chunked_sum(data, width, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Sum the rows of a table column, possibly memory mapped, reading at most
+    memory_budget bytes at a time so that only a chunk of the column is
+    in memory whatever the number of rows.
+    @param width: number of leading channels to sum
+    @return: (float64 array of width channels, number of summed rows)
+    """
+    row_bytes = max(1, width * data.dtype.itemsize)
+    chunk_rows = max(1, int(memory_budget // row_bytes))
+    total = np.zeros(width)
+    rows = 0
+    for start in range(0, len(data), chunk_rows):
+        chunk = data[start:start + chunk_rows, :width]
+        total += chunk.sum(0, dtype=np.float64)
+        rows += len(chunk)
+    return total, rows
 
 class ScanCycle(object):
-    def __init__(self, sections, duty_cycle):
+    """
+    Accumulates the spectra of a scan cycle.
+    Every flag, section and polarization is summed into a single float64
+    array of shape (flags, sections, polarizations, bins); sections with
+    less bins or a single polarization use only the leading part of their
+    slot. Samples and integration time are counted per flag and section.
+    An optional RFIFlagging drops bad rows while they are summed and masks
+    channels.
+    """
+    __slots__ = ("duty_cycle", "cycle_length", "section_ids",
+                 "section_index", "polarizations", "bins", "spectrum",
+                 "samples", "integration", "bytes_read", "files_opened",
+                 "flagging", "channel_mask", "flagged_rows")
+
+    def __init__(self, sections, duty_cycle, flagging=None):
         self.duty_cycle = duty_cycle
         self.cycle_length = sum(duty_cycle.values())
-        self.data = {}
-        for section in sections:
-            if section["type"] == "simple":
-                pols = ["simple"]
-            else:
-                pols = POLARIZATIONS
-            bins = section["bins"]
-            self.data[section["id"]] = {}
-            for pol in pols:
-                self.data[section["id"]][pol] = {}
-                for k,v in self.duty_cycle.items():
-                    self.data[section["id"]][pol][k] = np.zeros(1, 
-                                        dtype=[('spectrum',np.float32, (bins,)),
-                                        ('samples', np.int_),
-                                        ('integration', np.float64)])
+        self.section_ids = [section["id"] for section in sections]
+        self.section_index = dict((section_id, i) for i, section_id in
+                                  enumerate(self.section_ids))
+        self.polarizations = [section_polarizations(section)
+                              for section in sections]
+        self.bins = np.array([section["bins"] for section in sections],
+                             dtype=np.int_)
+        max_bins = self.bins.max() if len(self.bins) else 0
+        self.spectrum = np.zeros((len(FLAGS),
+                                  len(self.section_ids),
+                                  len(POLARIZATIONS),
+                                  max_bins))
+        self.samples = np.zeros((len(FLAGS), len(self.section_ids)),
+                                dtype=np.int_)
+        self.integration = np.zeros((len(FLAGS), len(self.section_ids)))
+        self.bytes_read = 0
+        self.files_opened = 0
+        self.flagging = flagging
+        self.flagged_rows = 0
+        self.channel_mask = None
+        if flagging and flagging.channel_ranges:
+            self.channel_mask = np.zeros((len(self.section_ids), 1, max_bins),
+                                         dtype=bool)
+            for s, section_id in enumerate(self.section_ids):
+                self.channel_mask[s, 0, :self.bins[s]] = \
+                    flagging.channel_mask(section_id, self.bins[s])
 
     @property
     def sections(self):
-        return list(self.data.keys())
+        return list(self.section_ids)
+
+    def layout(self):
+        """
+        @return: list of (section_id, polarization, section_index,
+        polarization_index) for every spectrum of the cycle
+        """
+        return [(section_id, pol, s, p)
+                for s, section_id in enumerate(self.section_ids)
+                for p, pol in enumerate(self.polarizations[s])]
+
+    def spectrum_view(self, flag, section_id, pol):
+        """
+        @return: a view on the summed spectrum, not normalized by samples
+        """
+        s = self.section_index[section_id]
+        p = self.polarizations[s].index(pol)
+        return self.spectrum[FLAGS.index(flag), s, p, :self.bins[s]]
 
-    def add_data(self, section_id, flag, pol, data, samples, integration):
+    def add_data(self, section_id, flag, data, samples, integration):
         """
-        @param data: a single spectrum file containing all polarizations
+        @param data: summed spectra of the section, one row per polarization
         """
-        self.data[section_id][pol][flag]["spectrum"] += data
-        self.data[section_id][pol][flag]["samples"] += samples
-        self.data[section_id][pol][flag]["integration"] += integration
+        s = self.section_index[section_id]
+        f = FLAGS.index(flag)
+        self.spectrum[f, s, :data.shape[0], :data.shape[1]] += data
+        self.samples[f, s] += samples
+        self.integration[f, s] += integration
 
-    def add_data_file(self, fits_file, flag="on"):
+    def add_data_file(self, fits_file, flag="on",
+                      memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        @param fits_file: subscan opened with memmap=True, so that data
+        columns are read in chunks of memory_budget bytes
+        """
         #TODO: add CAL flag check when implemented in fits file
+        self.files_opened += 1
         unit_integration = fits_file["SECTION TABLE"].header["Integration"] / 1000.0
+        data_table = fits_file["DATA TABLE"].data
         for section in fits_file["SECTION TABLE"].data:
-            self.add_section_data(section, 
+            self.add_section_data(section,
                                   flag,
                                   unit_integration,
-                                  fits_file["DATA TABLE"].data["Ch%d"%(section["id"])],
-                                  )
+                                  data_table.field("Ch%d"%(section["id"])),
+                                  memory_budget)
 
-    def add_section_data(self, section, flag, integration, data):
-        if section["type"] == "stokes":
-            pols = POLARIZATIONS
+    def add_section_data(self, section, flag, integration, data,
+                         memory_budget=DEFAULT_MEMORY_BUDGET):
+        s = self.section_index[section["id"]]
+        n_pols = len(self.polarizations[s])
+        bins = self.bins[s]
+        #stokes sections also carry Q and U after LCP and RCP
+        if self.flagging:
+            data_sum, rows = self.flagging.clipped_sum(data, n_pols, bins,
+                                                       memory_budget)
         else:
-            pols = ["simple"]
-        total_integration = len(data) * integration
-        data_sum = data.sum(0)
-        for i,pol in enumerate(pols):
-            data_start = i * section["bins"]
-            data_stop = data_start + section["bins"]
-            self.add_data(section["id"],
-                          flag,
-                          pol,
-                          data_sum[data_start:data_stop],
-                          len(data),
-                          total_integration)
+            data_sum, rows = chunked_sum(data, n_pols * bins, memory_budget)
+        self.bytes_read += int(len(data) * n_pols * bins * data.dtype.itemsize)
+        if rows < len(data):
+            logger.debug("section %d %s: flagged %d of %d rows" %
+                         (section["id"], flag, len(data) - rows, len(data)))
+            self.flagged_rows += len(data) - rows
+        self.add_data(section["id"],
+                      flag,
+                      data_sum.reshape(n_pols, bins),
+                      rows,
+                      rows * integration)
+
+    def mean(self, flag):
+        """
+        @return: (mean spectra of flag with shape (sections, polarizations,
+        bins), integration time of each section)
+        """
+        f = FLAGS.index(flag)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self.spectrum[f] / self.samples[f, :, np.newaxis, np.newaxis],
+                    self.integration[f].copy())
+
+    def set_reference(self, flag, spectrum, integration):
+        """
+        Use mean spectra measured outside of the cycle, such as references
+        shared with other cycles, for flag
+        @param spectrum: mean spectra (sections, polarizations, bins)
+        @param integration: integration time of each section
+        """
+        f = FLAGS.index(flag)
+        self.spectrum[f] = spectrum
+        self.samples[f] = 1
+        self.integration[f] = integration
 
     def onoffcal(self):
-        result = dict()
-        for s_id,section in self.data.items():
-            result[s_id] = dict()
-            for pol_id, data in section.items():
-                on = data['on'][0]["spectrum"] / data["on"][0]["samples"]
-                off = data['off'][0]["spectrum"] / data["off"][0]["samples"]
-                if "cal" in list(data.keys()):
-                    cal = data['cal'][0]["spectrum"] / data["cal"][0]["samples"]
-                else:
-                    cal = None
-                result[s_id][pol_id] = (on, off, cal)
-        return result
+        """
+        @return: (on, off, cal) mean spectra with shape (sections,
+        polarizations, bins), cal is None if no cal sample was collected
+        """
+        samples = self.samples[:, :, np.newaxis, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.spectrum / samples
+        on, off, cal = mean
+        if not self.samples[CAL].any():
+            cal = None
+        return on, off, cal
+
+    def calibration_window(self):
+        """
+        @return: boolean mask of shape (sections, 1, bins) selecting the
+        central third of each section, where cal and off levels are measured,
+        without masked channels
+        """
+        window = np.zeros((len(self.section_ids), 1, self.spectrum.shape[-1]),
+                          dtype=bool)
+        for s, bins in enumerate(self.bins):
+            start_bin = int(bins / 3)
+            stop_bin = 2 * start_bin
+            window[s, 0, start_bin:stop_bin] = True
+        if self.channel_mask is not None:
+            window &= ~self.channel_mask
+        return window
+
+    def calibrate(self, calibration_mark=None):
+        """
+        Calibrate all the spectra of the cycle at once as
+        ((on - off) / off) * tsys, with tsys = counts2kelvin * off_mean and
+        counts2kelvin = calibration_mark / (cal_mean - off_mean)
+        @param calibration_mark: array of shape (sections, polarizations),
+        None to skip kelvin calibration
+        @return: (spectra, tsys) arrays of shape (sections, polarizations,
+        bins) and (sections, polarizations); tsys is 1 when not calibrated;
+        masked channels are NaN
+        """
+        on, off, cal = self.onoffcal()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            spectra = (on - off) / off
+            if self.channel_mask is not None:
+                spectra[np.broadcast_to(self.channel_mask, spectra.shape)] = np.nan
+            if (calibration_mark is None) or (cal is None):
+                logger.debug("skip calibration")
+                tsys = np.ones(spectra.shape[:2])
+                return spectra, tsys
+            window = self.calibration_window()
+            window_size = window.sum(-1)
+            cal_mean = np.where(window, cal, 0.).sum(-1) / window_size
+            off_mean = np.where(window, off, 0.).sum(-1) / window_size
+            counts2kelvin = calibration_mark / (cal_mean - off_mean)
+            tsys = counts2kelvin * off_mean
+            spectra *= tsys[:, :, np.newaxis]
+        logger.debug("tsys: %s" % (str(tsys),))
+        return spectra, tsys
 
+
+class CycleAverage(object):
+    """
+    Running average of the calibrated spectra of consecutive cycles, each
+    cycle weighted by the on source integration time of its sections
+    """
+    __slots__ = ("section_ids", "spectra", "tsys", "integration", "cycles")
+
+    def __init__(self, section_ids):
+        self.section_ids = list(section_ids)
+        self.spectra = None
+        self.tsys = None
+        self.integration = np.zeros(len(self.section_ids))
+        self.cycles = 0
+
+    def add(self, spectra, tsys, integration):
+        """
+        @param spectra: calibrated spectra (sections, polarizations, bins)
+        @param tsys: (sections, polarizations)
+        @param integration: on source integration of each section
+        """
+        weights = integration[:, np.newaxis]
+        if self.spectra is None:
+            self.spectra = np.zeros_like(spectra)
+            self.tsys = np.zeros_like(tsys)
+        self.spectra += spectra * weights[:, :, np.newaxis]
+        self.tsys += tsys * weights
+        self.integration += integration
+        self.cycles += 1
+
+    def average(self):
+        """
+        @return: (spectra, tsys, integration) where integration is the
+        total integration of each section
+        """
+        weights = self.integration[:, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self.spectra / weights[:, :, np.newaxis],
+                    self.tsys / weights,
+                    self.integration)
@@ -0,0 +1,98 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+#speed of light in km/s
+CLIGHT = 299792.458
+#CLASS dates are counted in days from this MJD
+CLASS_DATE_OFFSET = 60549
+
+
+class ReducedSpectrum(object):
+    """
+    Calibrated spectrum of a section and polarization of a scan cycle,
+    together with every header value needed to write it as an observation.
+    Only plain python values and a numpy array are stored, so that reduced
+    spectra can be passed between processes.
+      - data: calibrated spectrum, tsys: system temperature (K)
+      - mjd: observation time, ut and st in radians
+      - az, el, ra, dec: radians
+      - rest_frequency, fres, foff: MHz, rchan: reference channel
+      - vres, voff: km/s, doppler: in units of c
+      - integration: on source integration time in seconds
+    """
+    def __init__(self, metadata, spectrum, summary, section, polarization,
+                 integration, data, tsys, cycle=0):
+        self.cycle = cycle
+        self.section = section
+        self.polarization = polarization
+        self.line = "SEC%d-%s" % (section, polarization)
+        self.source_name = metadata.source_name
+        self.antenna = metadata.antenna
+        self.scan = metadata.ScanID
+        self.subscan = metadata.SubScanID
+        self.mjd = metadata.observation_mjd
+        self.dobs = int(self.mjd) - CLASS_DATE_OFFSET
+        self.dred = int(metadata.record_mjd) - CLASS_DATE_OFFSET
+        self.ut = (self.mjd - int(self.mjd)) * np.pi * 2
+        self.st = metadata.sidereal_time
+        self.az = metadata.azimut  # unit radians
+        self.el = metadata.elevation # radians
+        self.ra = metadata.ra
+        self.dec = metadata.dec
+        self.integration = integration
+        self.tamb = float(metadata.tamb + 273.15) # must be in K
+        self.pamb = float(metadata.pamb)
+        self.rest_frequency = spectrum.rest_frequency
+        self.nchan = spectrum.bins
+        self.rchan = spectrum.central_channel
+        self.fres = spectrum.freq_resolution
+        self.foff = spectrum.offsetFrequencyAt0
+        # frequency resolution must have the same unity like the central_frequency
+        self.vres = - (spectrum.freq_resolution / spectrum.central_frequency) * CLIGHT
+        self.voff = summary["velocity"]["vrad"]
+        self.vframe = summary["velocity"]["vframe"]
+        v_observer = -((spectrum.central_frequency - spectrum.rest_frequency) /
+                                  spectrum.rest_frequency) * CLIGHT
+        #doppler in units of c light
+        #the negative sign is a class convention.
+        self.doppler = - (v_observer + self.voff) / CLIGHT
+        self.tsys = tsys
+        self.data = data
+
+    def resampled(self, data, first_channel, factor):
+        """
+        Replace data with a subset of channels, starting at first_channel,
+        rebinned by factor, updating the spectral axis description
+        """
+        self.data = data
+        self.nchan = len(data)
+        #centre of the first rebinned channel in original channels
+        self.rchan = (self.rchan - first_channel - (factor + 1) / 2.) / factor + 1
+        self.fres *= factor
+        self.vres *= factor
+
+    def __repr__(self):
+        return "ReducedSpectrum(%s, scan %d subscan %d, %s)" % (self.source_name,
+                                                                self.scan,
+                                                                self.subscan,
+                                                                self.line)
@@ -0,0 +1,111 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import time
+import logging
+logger = logging.getLogger(__name__)
+from contextlib import contextmanager
+
+#conversion stages, in execution order
+STAGES = ["index", "summary", "read", "metadata", "calibration", "write"]
+COUNTERS = ["files_opened", "bytes_read", "flagged_rows", "cycles",
+            "spectra", "observations"]
+
+
+class ConversionStats(object):
+    """
+    Wall time spent in each conversion stage and counters of the work done:
+      - index: reading subscan headers into the subscan index
+      - summary: loading the scan summary file
+      - read: reading and summing spectral data into cycle accumulators,
+        also when done by background threads overlapping other stages
+      - metadata: building cycle metadata and header values
+      - calibration: on/off/cal reduction and kelvin calibration
+      - write: writing CLASS observations
+    Since reads overlap other stages, the sum of stage times can exceed the
+    wall time, measured separately around the conversion.
+    """
+    def __init__(self):
+        self.stages = dict((stage, 0.) for stage in STAGES)
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        self.wall_time = 0.
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    @contextmanager
+    def wall_clock(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.wall_time += time.perf_counter() - start
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        for name, value in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.) + value
+        for name, value in other.counters.items():
+            self.count(name, value)
+        self.wall_time += other.wall_time
+
+    @property
+    def total_time(self):
+        """
+        @return: the sum of stage times, including background reads
+        """
+        return sum(self.stages.values())
+
+    def as_dict(self):
+        return dict(stages = dict(self.stages),
+                    counters = dict(self.counters),
+                    total_time = self.total_time,
+                    wall_time = self.wall_time)
+
+
+def write_report(path, results, wall_time=None):
+    """
+    Write a JSON report of the stats of every converted scan and of the
+    whole run
+    @param results: list of ScanResult
+    @param wall_time: measured wall time of the whole run, scans converted
+    by parallel jobs overlap
+    """
+    run = ConversionStats()
+    scans = {}
+    for result in results:
+        if result.stats is not None:
+            run.merge(result.stats)
+            scans[result.scan_path] = result.stats.as_dict()
+    if wall_time is not None:
+        run.wall_time = wall_time
+    with open(path, "w") as report:
+        json.dump(dict(run = run.as_dict(), scans = scans), report,
+                  indent=1, sort_keys=True)
+    logger.info("conversion stats written to %s" % (path,))
@@ -0,0 +1,98 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+from .compressed import is_gzip, read_row
+
+
+def _native(value):
+    """
+    convert numpy scalars and arrays to plain python values
+    """
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return value
+
+def _table_rows(table):
+    names = table.columns.names
+    return [dict((name, _native(row[name])) for name in names)
+            for row in table]
+
+
+class SubscanInfo(object):
+    """
+    Header level description of a subscan file. Only the FITS headers, the
+    small SECTION TABLE and RF INPUTS tables and the first row of the
+    DATA TABLE are read, spectral data is never touched.
+    """
+    def __init__(self, path):
+        from astropy.io import fits
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        with fits.open(path, memmap=True, lazy_load_hdus=True) as subscan:
+            header = subscan[0].header
+            self.signal = header.get("SIGNAL", "")
+            self.site_longitude = header["SiteLongitude"]
+            self.site_latitude = header["SiteLatitude"]
+            self.ra = header["RightAscension"]
+            self.dec = header["Declination"]
+            self.date = header["DATE"]
+            self.antenna = header["ANTENNA"]
+            self.scan_id = header["SCANID"]
+            self.subscan_id = header["SubScanID"]
+            self.source_name = header["SOURCE"]
+            section_table = subscan["SECTION TABLE"]
+            self.integration = section_table.header["Integration"] / 1000.0
+            self.sections = _table_rows(section_table.data)
+            self.rf_inputs = _table_rows(subscan["RF INPUTS"].data)
+            data_hdu = subscan.index_of("DATA TABLE")
+            data_offset = subscan.fileinfo(data_hdu)["datLoc"]
+            #headers, small tables and the first data row
+            self.header_bytes = int(data_offset +
+                                    subscan[data_hdu].header["NAXIS1"])
+            if is_gzip(path):
+                #do not decompress the whole table for its first row
+                first_row = read_row(path, data_offset,
+                                     subscan[data_hdu].columns.dtype.newbyteorder(">"))
+            else:
+                first_row = subscan[data_hdu].data[0]
+            self.mjd = float(first_row["time"])
+            self.azimut = float(first_row["az"])
+            self.elevation = float(first_row["el"])
+            self.weather = _native(first_row["weather"])
+
+    def __repr__(self):
+        return "SubscanInfo(%s, %s, %f)" % (self.path, self.signal, self.mjd)
+
+
+def load_subscan_index(scan_path, file_names):
+    """
+    Build the index of the given subscan files found in scan_path
+    @return: a list of SubscanInfo ordered by first data timestamp
+    """
+    index = []
+    for file_name in file_names:
+        index.append(SubscanInfo(os.path.join(scan_path, file_name)))
+    #order file names by internal data timestamp
+    index.sort(key=lambda x:x.mjd)
+    return index
@@ -0,0 +1,194 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import logging
+import threading
+logger = logging.getLogger(__name__)
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from .dutycycle import signal_flag
+
+NEAREST = "nearest"
+INTERPOLATE = "interpolate"
+MODES = [NEAREST, INTERPOLATE]
+#reduced reference runs kept in memory
+DEFAULT_REFERENCE_CACHE = 4
+
+
+class SubscanRun(object):
+    """
+    Consecutive subscans with the same SIGNAL
+      - indices: subscan index positions
+      - mjd: mean start time of the subscans
+    """
+    def __init__(self, flag, indices, mjd):
+        self.flag = flag
+        self.indices = indices
+        self.mjd = mjd
+
+    @property
+    def start(self):
+        return self.indices[0]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __repr__(self):
+        return "SubscanRun(%s, %d-%d)" % (self.flag, self.indices[0],
+                                          self.indices[-1])
+
+def subscan_runs(subscans):
+    """
+    Split a subscan index, ordered by time, into runs of consecutive
+    subscans with the same SIGNAL
+    @raise ValueError: for subscans with an unknown SIGNAL
+    """
+    groups = []
+    for i, subscan in enumerate(subscans):
+        flag = signal_flag(subscan.signal)
+        if flag is None:
+            raise ValueError("%s: unknown SIGNAL %s" %
+                             (os.path.basename(subscan.path), subscan.signal))
+        if groups and groups[-1][0] == flag:
+            groups[-1][1].append(i)
+        else:
+            groups.append((flag, [i]))
+    return [SubscanRun(flag, indices,
+                       sum(subscans[i].mjd for i in indices) / len(indices))
+            for flag, indices in groups]
+
+
+class SwitchingScheme(object):
+    """
+    Switching scheme read from the SIGNAL header of the subscans, where
+    every run of on subscans is a cycle and off and cal runs are references
+    shared by neighbouring on runs, as in on-off-on or multi-on schedules.
+    Each on run is paired, for off and cal separately, with:
+      - nearest: the reference run closest in time
+      - interpolate: the linear interpolation in time of the reference runs
+        before and after it, the nearest one at the edges of the scan
+    Reports like a ScanPlan.
+    """
+    def __init__(self, subscans, mode=NEAREST):
+        if mode not in MODES:
+            raise ValueError("unknown switching mode %s" % (mode,))
+        self.mode = mode
+        runs = subscan_runs(subscans)
+        self.on_runs = [run for run in runs if run.flag == "on"]
+        self.references = dict((flag, [run for run in runs if run.flag == flag])
+                               for flag in ("off", "cal"))
+        if not self.references["off"]:
+            raise ValueError("no off subscans to use as reference")
+        self.subscans = len(subscans)
+        self.cycles = len(self.on_runs)
+        self.partial_cycle_subscans = 0
+        self.mismatches = []
+        self.unknown = []
+
+    @property
+    def valid(self):
+        return self.cycles > 0
+
+    def pairs(self, run, flag):
+        """
+        @return: list of (reference run, weight) of flag for an on run,
+        empty if the scan has no reference of flag
+        """
+        references = self.references[flag]
+        before = [ref for ref in references if ref.mjd <= run.mjd]
+        after = [ref for ref in references if ref.mjd > run.mjd]
+        if not before or not after:
+            return [(ref, 1.) for ref in (before[-1:] or after[:1])]
+        before, after = before[-1], after[0]
+        if self.mode == NEAREST:
+            if run.mjd - before.mjd <= after.mjd - run.mjd:
+                return [(before, 1.)]
+            return [(after, 1.)]
+        weight = (run.mjd - before.mjd) / (after.mjd - before.mjd)
+        return [(before, 1. - weight), (after, weight)]
+
+    def cycle_subscans(self, cycle, flags=("off", "cal")):
+        """
+        @return: sorted indices of the on subscans of a cycle and of the
+        reference subscans it is paired with
+        """
+        run = self.on_runs[cycle]
+        indices = set(run.indices)
+        for flag in flags:
+            for ref, weight in self.pairs(run, flag):
+                indices.update(ref.indices)
+        return sorted(indices)
+
+    def log(self, scan_path):
+        logger.info("%s: %d subscans, %s switching, %d on, %d off and %d cal "
+                    "runs" % (scan_path, self.subscans, self.mode, self.cycles,
+                              len(self.references["off"]),
+                              len(self.references["cal"])))
+        if not self.references["cal"]:
+            logger.warning("%s: no cal subscans, spectra are not calibrated "
+                           "in kelvin" % (scan_path,))
+
+
+class ReferenceCache(object):
+    """
+    Least recently used cache of reduced reference runs, shared by the
+    threads reading cycles: each run is reduced only once while it is
+    cached, concurrent requests wait for the same reduction.
+    """
+    def __init__(self, size=DEFAULT_REFERENCE_CACHE):
+        self.size = size
+        #key -> future of the reduced reference
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return dict(size = self.size)
+
+    def __setstate__(self, state):
+        self.__init__(state["size"])
+
+    def get(self, key, reduce):
+        """
+        @param reduce: function reducing the reference when not cached
+        @return: (reference, True if reduced by this call)
+        """
+        with self.lock:
+            future = self.entries.get(key)
+            reduced = future is None
+            if reduced:
+                future = Future()
+                self.entries[key] = future
+                while len(self.entries) > max(self.size, 1):
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+        if reduced:
+            try:
+                future.set_result(reduce())
+            except Exception as e:
+                with self.lock:
+                    if self.entries.get(key) is future:
+                        del self.entries[key]
+                future.set_exception(e)
+        return future.result(), reduced
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
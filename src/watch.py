@@ -0,0 +1,319 @@
+#
+#
+#    Copyright (C) 2016  Marco Bartolini, bartolini@ira.inaf.it
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+logger = logging.getLogger(__name__)
+
+from .discosscan import DiscosScanConverter, DiscosScanException, is_data_file
+from .discosscan import DEFAULT_PREFETCH_CYCLES
+from .classwriter import ClassWriter
+from .scancycle import DEFAULT_MEMORY_BUDGET
+
+#inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT_HEADER = struct.Struct("iIII")
+
+#seconds a file must stay untouched before it is considered fully written
+DEFAULT_SETTLE_TIME = 5.0
+#seconds without new subscans after which a scan with a summary is complete
+DEFAULT_IDLE_TIMEOUT = 120.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+class PollingWatcher(object):
+    """
+    Fallback watcher: just waits, directories are listed at every poll
+    """
+    def add(self, path):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return []
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Linux inotify watcher based on ctypes, reports files closed after
+    writing and newly created directories
+    """
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, path):
+        if path in self.watches.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd,
+                                         os.fsencode(path),
+                                         INOTIFY_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          "cannot watch %s" % (path,))
+        self.watches[wd] = path
+
+    def wait(self, timeout):
+        """
+        @return: list of (path, mask) events received within timeout seconds
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if wd in self.watches:
+                events.append((os.path.join(self.watches[wd],
+                                            os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher():
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError) as e:
+        logger.info("inotify not available (%s), polling directories" % (e,))
+        return PollingWatcher()
+
+def is_scan_directory(path):
+    for file_name in os.listdir(path):
+        if((file_name.lower().startswith("sum")) or
+           is_data_file(file_name)):
+            return True
+    return False
+
+
+class ScanFollower(object):
+    """
+    Follows a scan directory while it is acquired, converting every cycle
+    as soon as its last subscan is fully written
+    """
+    def __init__(self, converter, settle_time=DEFAULT_SETTLE_TIME,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.converter = converter
+        self.settle_time = settle_time
+        self.idle_timeout = idle_timeout
+        self.indexed = set()
+        self.closed = set()
+        self.last_change = time.time()
+        self.complete = False
+
+    @property
+    def scan_path(self):
+        return self.converter.scan_path
+
+    def file_closed(self, file_name):
+        self.closed.add(file_name)
+
+    def _is_written(self, file_name, now):
+        if file_name in self.closed:
+            return True
+        try:
+            mtime = os.path.getmtime(os.path.join(self.scan_path, file_name))
+        except OSError:
+            return False
+        return now - mtime >= self.settle_time
+
+    def update(self, now=None):
+        """
+        Index the subscans written since the last update and convert the
+        cycles they complete
+        @return: the number of converted cycles
+        """
+        if now is None:
+            now = time.time()
+        subscan_files = self.converter.list_subscan_files()
+        new_files = [f for f in subscan_files if f not in self.indexed]
+        written = sorted(f for f in new_files if self._is_written(f, now))
+        if written:
+            try:
+                self.converter.add_subscans(written)
+            except Exception as e:
+                #will be retried at next update
+                logger.debug("cannot index subscans yet: %s" % (e,))
+                return 0
+            self.indexed.update(written)
+            self.last_change = now
+        if not self.converter.got_summary:
+            if self.converter.SUMMARY is None:
+                logger.debug("%s: waiting for summary file" % (self.scan_path,))
+                return 0
+            if not self._is_written(self.converter.SUMMARY, now):
+                return 0
+            self.converter.load_summary_info()
+            self.last_change = now
+        converted = self.converter.convert_pending_cycles()
+        if converted:
+            logger.info("%s: converted %d cycles" % (self.scan_path, converted))
+        if((len(written) == len(new_files)) and
+           (now - self.last_change >= self.idle_timeout)):
+            self.complete = True
+            #last block of averaged cycles
+            converted += self.converter.convert_pending_cycles(final=True)
+            logger.info("scan %s complete: %d cycles converted" %
+                        (self.scan_path, self.converter.n_cycles))
+            if self.converter.partial_cycle_subscans:
+                logger.warning("scan %s: ignoring %d subscans of an incomplete cycle" %
+                               (self.scan_path,
+                                self.converter.partial_cycle_subscans))
+            self.converter.record_scan()
+        return converted
+
+
+def watch(paths, duty_cycle, dest_dir, skip_calibration=False,
+          memory_budget=DEFAULT_MEMORY_BUDGET,
+          poll_interval=DEFAULT_POLL_INTERVAL,
+          settle_time=DEFAULT_SETTLE_TIME,
+          idle_timeout=DEFAULT_IDLE_TIMEOUT,
+          manifest=None, archive_format=None, average_cycles=1,
+          resampler=None, flagging=None,
+          prefetch_cycles=DEFAULT_PREFETCH_CYCLES, force=False):
+    """
+    Watch scan directories, or roots containing scan directories, and
+    append every cycle to the CLASS files as soon as it is acquired.
+    Returns when all the watched scans are complete; roots are watched
+    for new scans until interrupted. With a manifest, cycles and scans
+    already converted are skipped. With an archive_format, the archive of
+    each scan is updated together with the CLASS files. Blocks of
+    average_cycles cycles are converted as soon as they are complete, whole
+    scan averages when the scan is complete. With force, the manifest
+    records of followed scans are forgotten and the scans converted again.
+    """
+    watcher = make_watcher()
+    followers = {}
+    roots = []
+    finished = set()
+    writer = ClassWriter()
+
+    def follow(scan_path):
+        if scan_path in followers or scan_path in finished:
+            return
+        converter = DiscosScanConverter(scan_path, duty_cycle,
+                                        skip_calibration, memory_budget,
+                                        average_cycles)
+        converter.resampler = resampler
+        converter.flagging = flagging
+        converter.prefetch_cycles = prefetch_cycles
+        converter.set_output(dest_dir, writer)
+        converter.manifest = manifest
+        if archive_format:
+            converter.set_archive(dest_dir, archive_format)
+        if force and manifest is not None:
+            manifest.forget(scan_path)
+        if((manifest is not None) and
+           manifest.scan_done(scan_path, converter.list_subscan_files(),
+                              converter.reduction_options())):
+            logger.debug("%s: unchanged since last conversion" % (scan_path,))
+            finished.add(scan_path)
+            return
+        try:
+            converter.check_options()
+        except DiscosScanException as e:
+            logger.error(str(e))
+            finished.add(scan_path)
+            return
+        followers[scan_path] = ScanFollower(converter, settle_time,
+                                            idle_timeout)
+        watcher.add(scan_path)
+        logger.info("following scan %s" % (scan_path,))
+
+    #directories of the roots which are not scans yet -> mtime when listed
+    listed = {}
+
+    def scan_root(root):
+        for entry in os.scandir(root):
+            if entry.path in followers or entry.path in finished:
+                continue
+            if not entry.is_dir():
+                continue
+            #new files change the mtime of the directory
+            mtime = entry.stat().st_mtime
+            if listed.get(entry.path) == mtime:
+                continue
+            if is_scan_directory(entry.path):
+                listed.pop(entry.path, None)
+                follow(entry.path)
+            else:
+                listed[entry.path] = mtime
+
+    for path in paths:
+        path = os.path.normpath(path)
+        if is_scan_directory(path):
+            follow(path)
+        else:
+            roots.append(path)
+            watcher.add(path)
+            scan_root(path)
+    try:
+        while followers or roots:
+            for event_path, mask in watcher.wait(poll_interval):
+                directory, file_name = os.path.split(event_path)
+                if mask & IN_ISDIR:
+                    continue
+                if directory in followers and (mask & (IN_CLOSE_WRITE | IN_MOVED_TO)):
+                    followers[directory].file_closed(file_name)
+            for root in roots:
+                scan_root(root)
+            for scan_path, follower in list(followers.items()):
+                try:
+                    if follower.update():
+                        #let observers read the CLASS file while waiting
+                        writer.close()
+                        follower.converter.write_archive()
+                except Exception as e:
+                    logger.error("cannot convert scan at: %s" % (scan_path,))
+                    logger.error(str(e))
+                    follower.complete = True
+                if follower.complete:
+                    del followers[scan_path]
+                    finished.add(scan_path)
+    except KeyboardInterrupt:
+        logger.info("watch interrupted")
+    finally:
+        writer.close()
+        watcher.close()
+        if manifest is not None:
+            manifest.flush()